@@ -1,17 +1,27 @@
 import json
+import copy
+import functools
+import threading
 import boto3
 import streamlit as st
 from PIL import Image, ImageOps
 import uuid
+import hashlib
+import tempfile
 import random
 import os
 import io
 import requests
-import base64
 from streamlit_cognito_auth import CognitoAuthenticator
+from streamlit_autorefresh import st_autorefresh
 from botocore.exceptions import ClientError
 import logging
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from comfyui_client import (AvatarGenerationError, ComfyUIBackendPool, ComfyUIClient, ResultCache,
+                            comfyui_http_session, target_group_endpoints)
+from picture_description import cancel_describe, start_describe
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -27,11 +37,50 @@ image_moderation = True
 bedrock_runtime = boto3.client('bedrock-runtime', region_name='us-east-1')
 
 COMFYUI_ENDPOINT = f"{os.environ.get('COMFYUI')}:8181"
+# Optional comma separated list of ComfyUI backends (host:port), e.g. one per GPU instance
+COMFYUI_ENDPOINTS = [e.strip() for e in os.environ.get("COMFYUI_ENDPOINTS", "").split(",") if e.strip()]
+# "target-group" routes directly to the healthy ComfyUI tasks registered in COMFYUI_TARGET_GROUP_ARN
+COMFYUI_DISCOVERY = os.environ.get("COMFYUI_DISCOVERY", "static")
+COMFYUI_TARGET_GROUP_ARN = os.environ.get("COMFYUI_TARGET_GROUP_ARN")
+COMFYUI_BACKEND_REFRESH = float(os.environ.get("COMFYUI_BACKEND_REFRESH", "2"))
+# "websocket" waits for ComfyUI's execution events, "polling" only polls history/{prompt_id}
+COMFYUI_COMPLETION_MODE = os.environ.get("COMFYUI_COMPLETION_MODE", "websocket")
+# "websocket" swaps the PreviewImage node for SaveImageWebsocket and receives the PNG as binary frames
+COMFYUI_OUTPUT_MODE = os.environ.get("COMFYUI_OUTPUT_MODE", "websocket")
+COMFYUI_POOL_SIZE = int(os.environ.get("COMFYUI_POOL_SIZE", "20"))
+COMFYUI_CONNECT_TIMEOUT = float(os.environ.get("COMFYUI_CONNECT_TIMEOUT", "3.05"))
+COMFYUI_READ_TIMEOUT = float(os.environ.get("COMFYUI_READ_TIMEOUT", "30"))
+COMFYUI_RETRIES = int(os.environ.get("COMFYUI_RETRIES", "3"))
+AVATAR_JOB_WORKERS = int(os.environ.get("AVATAR_JOB_WORKERS", "8"))
+AVATAR_JOB_STORE_SIZE = int(os.environ.get("AVATAR_JOB_STORE_SIZE", "200"))
+ANALYSIS_WORKERS = int(os.environ.get("ANALYSIS_WORKERS", "8"))
+ANALYSIS_TIMEOUT = float(os.environ.get("ANALYSIS_TIMEOUT", "15"))
+# Opt-in: start the Bedrock description once a face is detected, so it is ready when "Describe picture"
+# is pressed. Every such upload pays for a model call, even if the picture is never described.
+SPECULATIVE_DESCRIBE = os.environ.get("SPECULATIVE_DESCRIBE", "false").lower() == "true"
+# Input images larger than this are spilled from memory to a temp file in input_dir
+INPUT_SPILL_THRESHOLD = int(os.environ.get("INPUT_SPILL_THRESHOLD", str(8 * 1024 * 1024)))
+TEMP_FILE_MAX_AGE = int(os.environ.get("TEMP_FILE_MAX_AGE", "3600"))
+TEMP_FILE_SWEEP_INTERVAL = int(os.environ.get("TEMP_FILE_SWEEP_INTERVAL", "600"))
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "32"))
+# Optional S3 tier for the result cache, e.g. "result-cache/" in the avatar bucket
+RESULT_CACHE_S3_PREFIX = os.environ.get("RESULT_CACHE_S3_PREFIX")
+# Bump when the models behind the workflow change so cached results are not reused
+COMFYUI_MODEL_VERSION = os.environ.get("COMFYUI_MODEL_VERSION", "1")
+# Opt-in: reuse face analysis across runs for the same photo. Needs a ReActor version with
+# ReActorBuildFaceModel and ComfyUI started with --cache-lru.
+FACE_CACHE = os.environ.get("FACE_CACHE", "false").lower() == "true"
 
 bucket = os.environ.get("S3_BUCKET")
 prefix = os.environ.get("S3_BUCKET_PREFIX")
+# Shared avatars are announced to the gallery index through event objects under this prefix
+gallery_index_prefix = os.environ.get("GALLERY_INDEX_PREFIX", "gallery-index/events/")
+# Gallery renditions, stored as <thumbnail_prefix><size>/<file name>.<jpeg|webp>. JPEG for a gallery
+# that sends images through Streamlit, WebP for one that serves signed URLs.
+thumbnail_prefix = os.environ.get("THUMBNAIL_PREFIX", "thumbnails/")
+thumbnail_sizes = (128, 256, 512)
+thumbnail_format = os.environ.get("THUMBNAIL_FORMAT", "JPEG").upper()
 
-local_path = "/tmp/"
 input_dir = "/tmp/input"
 output_dir = "/tmp/output"
 workflowfile = "dreamshaper_api.json"
@@ -72,6 +121,7 @@ session_state_defaults = {
     # "create_avatar_flag": False,
     "avatar_creation_in_progress": False,
     "avatar_final_image": None,
+    "avatar_job_id": None,
 }
 for key, value in session_state_defaults.items():
     if key not in st.session_state:
@@ -83,6 +133,9 @@ if 'comfyui_session' not in st.session_state:
 
 def start_avatar_creation():
     st.session_state.avatar_creation_in_progress = True
+    # A new variation per click. The seed is part of the result cache key, so only a request
+    # that is repeated with the same seed (a retry, a double submit) is served from the cache.
+    st.session_state["seed"] = int(random.random() * 1e8)
 
 comfyui_session = st.session_state.comfyui_session
 client_id = str(uuid.uuid4())
@@ -111,43 +164,155 @@ if image_moderation:
     client = session.client('rekognition')
     s3 = boto3.resource('s3')
 
-def make_comfyui_request(endpoint, method='GET', data=None, headers=None, files=None, params=None, cookies=None):
-    url = f"http://{COMFYUI_ENDPOINT}/{endpoint}"
-    try:
-        if method == 'GET':
-            response = requests.get(url, headers=headers, params=params, cookies=cookies)
-            logger.info(f"make_comfyui_request GET response status: {response.status_code}")
-        elif method == 'POST':
-            response = requests.post(url, data=data, headers=headers, files=files, params=params, cookies=cookies)
-            logger.info(f"make_comfyui_request POST response status: {response.status_code}")
-        else:
-            raise ValueError(f"Unsupported method {method}")
-        response.raise_for_status()
-        if response.headers.get('Content-Type', '').startswith('application/json'):
-            logger.info(f"Returning JSON response for {endpoint}")
-            return response.json()
-        else:
-            logger.info(f"Returning content response for {endpoint}")
-            return response.content
-    except requests.exceptions.HTTPError as e:
-        logger.error(f"HTTP error: {e.response.status_code} - {e.response.text}")
-        return None
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error making request to ComfyUI: {e}")
-        return None
+@st.cache_resource
+def get_comfyui_client():
+    # One keep-alive connection pool per process, shared by all Streamlit sessions
+    http_session = comfyui_http_session(COMFYUI_POOL_SIZE, COMFYUI_RETRIES)
+    return ComfyUIClient(COMFYUI_ENDPOINT, http_session, (COMFYUI_CONNECT_TIMEOUT, COMFYUI_READ_TIMEOUT),
+                         completion_mode=COMFYUI_COMPLETION_MODE, output_mode=COMFYUI_OUTPUT_MODE)
+
+@st.cache_resource
+def get_backend_pool():
+    discover = None
+    if COMFYUI_DISCOVERY == "target-group":
+        discover = functools.partial(target_group_endpoints, boto3.client('elbv2'), COMFYUI_TARGET_GROUP_ARN)
+    endpoints = COMFYUI_ENDPOINTS or [COMFYUI_ENDPOINT]
+    # Queue polls get their own session without retries, so a dead backend costs one short timeout
+    poll_client = ComfyUIClient(COMFYUI_ENDPOINT, comfyui_http_session(COMFYUI_POOL_SIZE, 0), (1, 2))
+    return ComfyUIBackendPool(poll_client, endpoints, COMFYUI_BACKEND_REFRESH, discover=discover)
 
 def is_comfyui_running():
     try:
-        response = make_comfyui_request('system_stats')
-        return response is not None
+        return len(get_backend_pool().healthy_backends()) > 0
     except requests.exceptions.RequestException as e:
         # logger.error(f"Error checking ComfyUI status: {e}")
         st.warning("Backend (ComfyUI) is not available. Please check your connection or ComfyUI configuration.")
         return False
 
+class TemplateRegistry:
+    """Process-wide cache of the workflow template and preset JSON files.
+    Files are parsed once and only reloaded when their mtime changes."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _load(self, path, build, cache_key=None):
+        cache_key = cache_key or path
+        mtime = os.stat(path).st_mtime_ns
+        entry = self._entries.get(cache_key)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        with self._lock:
+            with open(path, 'r', encoding='utf-8') as json_file:
+                value = build(json.load(json_file))
+            self._entries[cache_key] = (mtime, value)
+            logger.info(f"Loaded {path} into template registry")
+            return value
+
+    def workflow(self, path=workflowfile):
+        # Callers mutate the graph, so hand out a copy of the parsed template
+        return copy.deepcopy(self._load(path, lambda data: data))
+
+    def presets(self, path, key):
+        """Returns the preset list (for display order) and a dict indexed by key."""
+        return self._load(path, lambda items: (items, {item[key]: item for item in items}),
+                          cache_key=f"{path}:{key}")
+
+    def negative_prompts(self, path=negative_prompt_file):
+        return self._load(path, lambda items: {item['negative_prompt']: item['prompt'] for item in items})
+
+@st.cache_resource
+def get_template_registry():
+    return TemplateRegistry()
+
+class GenerationJob:
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.state = "queued"  # queued, running, done, failed, moderated
+        self.image = None
+        self.labels = []
+        self.error = None
+        self.created_at = time.time()
+
+    @property
+    def finished(self):
+        return self.state in ("done", "failed", "moderated")
+
+class JobManager:
+    """Runs avatar generations on a bounded thread pool, outside of the Streamlit script run.
+    Jobs are kept in a bounded in-process store and looked up by job ID on each rerun."""
+
+    def __init__(self, max_workers, max_jobs):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="avatar-job")
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_jobs = max_jobs
+
+    def submit(self, fn, *args):
+        job = GenerationJob(str(uuid.uuid4()))
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._evict()
+        self._executor.submit(self._run, job, fn, args)
+        logger.info(f"Queued generation job {job.job_id}")
+        return job.job_id
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, fn, args):
+        job.state = "running"
+        try:
+            job.state = fn(job, *args)
+        except AvatarGenerationError as e:
+            job.error = str(e)
+            job.state = "failed"
+        except Exception as e:
+            logger.exception(f"Generation job {job.job_id} failed: {e}")
+            job.error = "Failed to create the avatar. Please try again."
+            job.state = "failed"
+        logger.info(f"Generation job {job.job_id} finished with state {job.state}")
+
+    def _evict(self):
+        # Drop the oldest finished jobs first, only then the oldest pending ones
+        while len(self._jobs) > self._max_jobs:
+            victim = next((job_id for job_id, job in self._jobs.items() if job.finished), None)
+            if victim is None:
+                victim = next(iter(self._jobs))
+            del self._jobs[victim]
+
+def result_cache_key(image, prompt_data):
+    # Input pixels, the resolved workflow and the model version fully determine the output.
+    # The uploaded file name is random per upload, so it is left out.
+    workflow = copy.deepcopy(prompt_data)
+    workflow["53"]["inputs"]["image"] = None
+    digest = hashlib.sha256()
+    digest.update(image.image.tobytes())
+    digest.update(json.dumps(workflow, sort_keys=True).encode("utf-8"))
+    digest.update(COMFYUI_MODEL_VERSION.encode("utf-8"))
+    return digest.hexdigest()
+
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(RESULT_CACHE_SIZE, s3_client=boto3.client('s3'), s3_bucket=bucket,
+                       s3_prefix=RESULT_CACHE_S3_PREFIX)
+
+@st.cache_resource
+def get_analysis_executor():
+    # Bounded pool shared by all sessions for Rekognition and Bedrock calls
+    return ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix="analysis")
+
+@st.cache_resource
+def get_job_manager():
+    return JobManager(AVATAR_JOB_WORKERS, AVATAR_JOB_STORE_SIZE)
+
 def clear_session_state():
     keys_to_clear = [
         "img_file_buffer",
+        "normalized_image",
         "filename",
         "avatar_final_image",
         "glb_photo_name",
@@ -155,11 +320,20 @@ def clear_session_state():
         "displayed_avatar",
         "response_body",
         "avatar_shared",
-        "face_detected"
+        "face_detected",
+        "avatar_job_id",
+        "describe_future",
+        "seed"
     ]
+    # A speculative description still waiting for a worker is not needed anymore
+    cancel_describe(st.session_state.get("describe_future"))
     for key in keys_to_clear:
         if key in st.session_state:
             del st.session_state[key]
+    # The rest of this run still reads these keys, the defaults are only applied at the top of the script
+    for key in keys_to_clear:
+        if key in session_state_defaults:
+            st.session_state[key] = session_state_defaults[key]
 
     # Reset random values
     for rnd_key in rnd_max_values.keys():
@@ -184,10 +358,14 @@ def moderate_image(photo, bucket):
 class RekognitionImage:
 
     def __init__(self, image, image_name, rekognition_client):
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='PNG')
-        img_byte_arr = img_byte_arr.getvalue()
-        self.image = img_byte_arr
+        if isinstance(image, bytes):
+            # Already encoded (JPEG or PNG), no need to decode and re-encode
+            self.image = image
+        else:
+            img_byte_arr = io.BytesIO()
+            image.save(img_byte_arr, format='PNG')
+            img_byte_arr = img_byte_arr.getvalue()
+            self.image = img_byte_arr
         self.image_name = image_name
         self.rekognition_client = rekognition_client
 
@@ -210,199 +388,204 @@ class RekognitionImage:
         labels = [label['Name'] for label in response["ModerationLabels"]]
         return labels
 
-def upload_image(input_path, name, comfyui_session, image_type="input", overwrite=False):
-    with open(input_path, 'rb') as file:
-        files = {
-            'image': (name, file, 'image/jpeg'),
-        }
-        data = {
-            'type': image_type,
-            'overwrite': str(overwrite).lower()
-        }
-        cookies = {'COMFY-SESSION': comfyui_session}
-        return make_comfyui_request('upload/image', method='POST', data=data, files=files, cookies=cookies)
-
+def open_input_file(image_bytes):
+    # Stays in memory unless the image exceeds INPUT_SPILL_THRESHOLD, the file is deleted on close
+    input_file = tempfile.SpooledTemporaryFile(max_size=INPUT_SPILL_THRESHOLD, dir=input_dir)
+    input_file.write(image_bytes)
+    input_file.seek(0)
+    return input_file
+
+def write_gallery_event(op, key, last_modified=None, etag=None):
+    # Event keys sort by time, the gallery lists only the keys after its cursor
+    event_key = f"{gallery_index_prefix}{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.json"
+    event = {"op": op, "key": key, "last_modified": last_modified, "etag": etag}
+    s3.meta.client.put_object(Bucket=bucket, Key=event_key, Body=json.dumps(event).encode("utf-8"),
+                              ContentType="application/json")
+
+def upload_thumbnails(image_data, file_name):
+    for size in thumbnail_sizes:
+        thumbnail = image_data.convert('RGB')
+        thumbnail.thumbnail((size, size), Image.LANCZOS)
+        with io.BytesIO() as buf:
+            thumbnail.save(buf, format=thumbnail_format, quality=80)
+            s3.meta.client.put_object(Bucket=bucket,
+                                      Key=f"{thumbnail_prefix}{size}/{file_name}.{thumbnail_format.lower()}",
+                                      Body=buf.getvalue(), ContentType=f"image/{thumbnail_format.lower()}")
 
 def share_avatar(image_data):
-    output_image_name = local_path + "output/" + st.session_state["glb_photo_name"]
-    image_data.save(output_image_name)
     if image_moderation:
         s3_key = prefix + st.session_state["glb_photo_name"]
-        s3.meta.client.upload_file(output_image_name, bucket, s3_key)
-
-def parse_workflow(prompt, negative_prompt, seed, input_image_name, filename, comfyui_session):
-    image.convert('RGB').save(input_image_name, "JPEG")
-    with open(workflowfile, 'r', encoding="utf-8") as workflow_api_txt2gif_file:
+        with io.BytesIO() as output_buffer:
+            image_data.save(output_buffer, format='JPEG')
+            response = s3.meta.client.put_object(Bucket=bucket, Key=s3_key, Body=output_buffer.getvalue(),
+                                                 ContentType='image/jpeg')
+        upload_thumbnails(image_data, st.session_state["glb_photo_name"])
+        write_gallery_event("put", s3_key, time.time(), response['ETag'])
+
+def sweep_temp_files(max_age):
+    # Removes files left behind in the temp dirs, e.g. by a crashed process
+    removed = 0
+    now = time.time()
+    for directory in (input_dir, output_dir):
+        for entry in os.scandir(directory):
+            try:
+                if entry.is_file() and now - entry.stat().st_mtime > max_age:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError as e:
+                logger.warning(f"Could not remove temp file {entry.path}: {e}")
+    if removed:
+        logger.info(f"Removed {removed} stale temp file(s)")
+
+@st.cache_resource
+def start_temp_file_sweeper():
+    def sweep_forever():
+        while True:
+            sweep_temp_files(TEMP_FILE_MAX_AGE)
+            time.sleep(TEMP_FILE_SWEEP_INTERVAL)
+    sweeper = threading.Thread(target=sweep_forever, name="temp-file-sweeper", daemon=True)
+    sweeper.start()
+    return sweeper
+
+start_temp_file_sweeper()
+
+def build_workflow(prompt, negative_prompt, seed, filename):
+    prompt_data = get_template_registry().workflow()
+    # Set prompts and seed
+    prompt_data["46"]["inputs"]["text"] = prompt
+    prompt_data["47"]["inputs"]["text"] = negative_prompt
+    prompt_data["45"]["inputs"]["noise_seed"] = seed
+    prompt_data["53"]["inputs"]["image"] = filename
+    if FACE_CACHE and get_comfyui_client().has_node("ReActorBuildFaceModel"):
+        prompt_data = use_face_model(prompt_data)
+    return prompt_data
+
+def use_face_model(prompt_data):
+    # ReActor analyses the source face once in ReActorBuildFaceModel and the swap node takes the
+    # resulting face model. With a content-addressed upload name, LoadImage, IPAdapter (FaceID
+    # embedding) and the face model node get the same input signature on every run for the same
+    # photo, so ComfyUI's LRU cache serves them instead of re-running insightface.
+    prompt_data["61"] = {
+        "inputs": {
+            "save_mode": False,
+            "send_only": True,
+            "face_model_name": "default",
+            "compute_method": "Mean",
+            "images": ["53", 0]
+        },
+        "class_type": "ReActorBuildFaceModel"
+    }
+    swap_inputs = prompt_data["56"]["inputs"]
+    del swap_inputs["source_image"]
+    swap_inputs["face_model"] = ["61", 0]
+    return prompt_data
+
+def parse_workflow(comfyui, prompt_data, input_file, filename, comfyui_session, client_id, backend):
+    try:
         # First upload Image to ComfyUI
-        upload_image(input_image_name, filename, comfyui_session, overwrite=True)
-        prompt_data = json.load(workflow_api_txt2gif_file)
-        # Set prompts and seed
-        prompt_data["46"]["inputs"]["text"] = prompt
-        prompt_data["47"]["inputs"]["text"] = negative_prompt
-        prompt_data["45"]["inputs"]["noise_seed"] = seed
-        prompt_data["53"]["inputs"]["image"] = filename
-        return get_images(prompt_data, input_image_name, comfyui_session)
-
-
-def queue_prompt(prompt_data):
-    comfyui_session = st.session_state.comfyui_session
-    data = {"prompt": prompt_data, "client_id": client_id}
-    cookies = {'COMFY-SESSION': comfyui_session}
-    logger.info(f"Queueing prompt with data: {data}")
-    response = make_comfyui_request('prompt', 
-                                    method='POST', 
-                                    data=json.dumps(data).encode("utf-8"), 
-                                    cookies=cookies)
-    return response 
+        comfyui.upload_image(input_file, filename, comfyui_session, backend, overwrite=True)
+        return comfyui.get_images(prompt_data, comfyui_session, client_id, backend)
+    finally:
+        input_file.close()
 
-def preprocess_image(uploaded_file, max_size=1024):
-    try:
-        file_content = uploaded_file.read()
 
+class NormalizedImage:
+    """An uploaded photo decoded once, with EXIF orientation applied and downscaled to max_size.
+    Encoded forms for Rekognition, ComfyUI and Bedrock are created lazily and cached per format."""
+
+    def __init__(self, file_content, max_size=1024):
         with Image.open(io.BytesIO(file_content)) as img:
+            # Let the JPEG decoder scale down by a power of two while decoding
+            img.draft('RGB', (max_size, max_size))
+            img = ImageOps.exif_transpose(img)
             img = img.convert('RGB')
-            max_dim = max(img.width, img.height)
-
-            # Only resize if the image is larger than max_size
-            if max_dim > max_size:
-                ratio = max_size / max_dim
-                new_size = (int(img.width * ratio), int(img.height * ratio))
-                img = img.resize(new_size, Image.LANCZOS)
+        # Only resize if the image is larger than max_size, reduce() first and LANCZOS for the rest
+        img.thumbnail((max_size, max_size), Image.LANCZOS, reducing_gap=2.0)
+        self.image = img
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    def content_hash(self):
+        return hashlib.sha256(self.encoded('JPEG')).hexdigest()
+
+    def encoded(self, format='JPEG'):
+        with self._lock:
+            if format not in self._encoded:
+                img_byte_arr = io.BytesIO()
+                self.image.save(img_byte_arr, format=format)
+                self._encoded[format] = img_byte_arr.getvalue()
+            return self._encoded[format]
 
-            img_byte_arr = io.BytesIO()
-            img.save(img_byte_arr, format='PNG')
-            return img_byte_arr.getvalue()
+def preprocess_image(uploaded_file, max_size=1024):
+    try:
+        return NormalizedImage(uploaded_file.getvalue(), max_size=max_size)
     except Exception as e:
         st.error(f"Error processing image: {str(e)}")
         return None
 
-def get_history(prompt_id):
-    cookies = {'COMFY-SESSION': comfyui_session}
-    logger.info(f"get_history prompt_id: {prompt_id}")
-    logger.info(f"get_history comfyui_session: {comfyui_session}")
-    response = make_comfyui_request(f'history/{prompt_id}', 
-                                    method='GET', 
-                                    cookies=cookies)
-    logger.info(f"get_history response: {response}")
-    return response 
-
-def get_image(filename, subfolder, folder_type, comfyui_session):
-    params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
-    cookies = {'COMFY-SESSION': comfyui_session}
-    response = make_comfyui_request('view', 
-                                    method='GET', 
-                                    params=params, 
-                                    cookies=cookies)
-    return response
-
-def get_images(prompt_data, input_image_name, comfyui_session):
-    response = queue_prompt(prompt_data)
-    if response is None:
-        logger.error("Failed to queue prompt.")
-        st.error("Failed to queue prompt.")
-        return {}
-    
-    prompt_id = response.get('prompt_id')
-
-    output_images = {}
-    overall_timeout = 20  # Total timeout in seconds
-    initial_wait = 2  # Initial wait before first check
-    check_interval = 1.5  # Interval between checks
-    extended_interval = 3  # Extended interval for later checks
-    switch_to_extended_at = 7.5  # Time to switch to extended interval
-
-    start_time = time.time()
-
-    msg = st.toast('Avatar creation triggered...')
-    
-    def attempt_fetch_images():
-        nonlocal output_images
+def generate_avatar(job, comfyui, backend_pool, analysis_executor, result_cache, image, prompt_data, filename,
+                    comfyui_session, client_id):
+    # Runs on a JobManager worker thread: no Streamlit calls or session_state access here
+    image_bytes, job.labels = result_cache.get_or_compute(
+        result_cache_key(image, prompt_data),
+        lambda: run_generation(job, comfyui, backend_pool, analysis_executor, image, prompt_data, filename,
+                               comfyui_session, client_id)
+    )
+    job.image = Image.open(io.BytesIO(image_bytes))
+    job.image.load()
+    return "moderated" if job.labels else "done"
+
+def run_generation(job, comfyui, backend_pool, analysis_executor, image, prompt_data, filename, comfyui_session,
+                   client_id):
+    """Runs the workflow and moderation, returns the avatar's encoded bytes and its moderation labels."""
+    # Upload, prompt, history and view calls are all pinned to the backend that accepted the prompt
+    backend = backend_pool.acquire()
+    if backend is None:
+        raise AvatarGenerationError("Backend (ComfyUI) is not available. Please try again.")
+    logger.info(f"Routing job {job.job_id} to ComfyUI backend {backend}")
+    input_file = open_input_file(image.encoded('JPEG'))
+    images = parse_workflow(comfyui, prompt_data, input_file, filename, comfyui_session, client_id, backend)
+    valid_images = []
+    for node_id in images:
+        for image_output in images[node_id]:
+            try:
+                Image.open(io.BytesIO(image_output)).verify()
+                valid_images.append(image_output)
+            except Exception as e:
+                logger.error(f"Error processing image: {e}")
+    if not valid_images:
+        raise AvatarGenerationError("Failed to fetch the avatar. Please try again.")
+
+    labels = []
+    if image_moderation:
+        # Moderate all output images concurrently, the labels of the displayed image decide.
+        # Rekognition gets the PNG bytes as returned by ComfyUI.
+        moderation_futures = [
+            analysis_executor.submit(RekognitionImage(image_output, job.job_id, client).detect_moderation_labels)
+            for image_output in valid_images
+        ]
         try:
-            history = get_history(prompt_id)
-            if history and prompt_id in history:
-                for node_id, node_output in history[prompt_id].get('outputs', {}).items():
-                    if 'images' in node_output:
-                        images_output = []
-                        for image_info in node_output['images']:
-                            image_data = get_image(
-                                image_info['filename'],
-                                image_info['subfolder'],
-                                image_info['type'],
-                                comfyui_session
-                            )
-                            images_output.append(image_data)
-                        output_images[node_id] = images_output
-            return bool(output_images)
-        except Exception as e:
-            logger.error(f"Failed to fetch images: {e}")
-            return False
-
-    time.sleep(initial_wait)
-    attempt = 0
-
-    # Polling loop
-    while True:
-        elapsed_time = time.time() - start_time
-
-        if elapsed_time > overall_timeout:
-            st.error("Timeout reached while waiting for images. Please try again")
-            break
-
-        if attempt_fetch_images():
-            msg.toast('Images fetched successfully.')
-            break
-
-        if elapsed_time < switch_to_extended_at:
-            interval = check_interval
-        else:
-            interval = extended_interval
-
-        if attempt == 5:
-            msg.toast('only a few seconds more...')
-        
-        attempt += 1
-        time.sleep(interval)
+            labels = [future.result(timeout=ANALYSIS_TIMEOUT) for future in moderation_futures][-1]
+        except FutureTimeoutError:
+            raise AvatarGenerationError("Image moderation timed out. Please try again.")
+        logger.info(f"Moderation labels detected: {labels}")
+    return valid_images[-1], labels
 
-    # Final attempt to fetch images if not already fetched
-    if not output_images:
-        attempt_fetch_images()
-
-    if not output_images:
-        st.session_state['avatar_creation_in_progress'] = False
-        st.error("Failed to fetch the avatar. Please try again.")
-
-    os.remove(input_image_name)
-    return output_images
+def start_describe_picture(normalized_image):
+    return start_describe(get_analysis_executor(), bedrock_runtime, normalized_image)
 
 def describe_picture():
-    if st.session_state.get("img_file_buffer") is not None:
-        with Image.open(st.session_state.get("img_file_buffer")) as image:
-            with io.BytesIO() as buf:
-                image.save(buf, 'jpeg')
-                image_bytes = buf.getvalue()
-                encoded_image = base64.b64encode(image_bytes).decode('utf8')
-
-        body = json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 500,
-            "messages": [{
-                "role": "user",
-                "content": [{
-                    "type": "image",
-                    "source": {
-                        "type": "base64",
-                        "media_type": "image/jpeg",
-                        "data": encoded_image,
-                    },
-                },
-                    {"type": "text", "text": "What is in this image?"}, ],
-            }]
-        })
-        response = bedrock_runtime.invoke_model(
-            modelId="anthropic.claude-3-haiku-20240307-v1:0",
-            body=body
-        )
-        st.session_state["response_body"] = json.loads(response.get("body").read())
+    if st.session_state.get("normalized_image") is not None:
+        # Reuse the speculative description started at upload time if there is one
+        future = st.session_state.get("describe_future")
+        if future is None:
+            future = start_describe_picture(st.session_state["normalized_image"])
+            st.session_state["describe_future"] = future
+        try:
+            st.session_state["response_body"] = future.result(timeout=ANALYSIS_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Describe picture failed: {e}")
+            st.session_state["response_body"] = {"error": str(e)}
 
 def logout():
     clear_session_state()
@@ -444,16 +627,27 @@ if st.session_state['authenticated']:
                 st.session_state['img_file_buffer'] = uploaded_file
                 st.session_state['filename'] = "photo-" + str(uuid.uuid4())[-17:] + ".png"
 
-                # Preprocess and perform face detection
+                # Decode once, every consumer works from this object
                 processed_image = preprocess_image(st.session_state['img_file_buffer'], max_size=1024)
+                st.session_state['normalized_image'] = processed_image
                 if processed_image:
+                    # Stable name per photo content, so ComfyUI can reuse cached face analysis
+                    st.session_state['filename'] = "face-" + processed_image.content_hash()[:16] + ".jpeg"
+
+                    # Perform face detection
                     try:
-                        rekog_portrait = RekognitionImage(Image.open(io.BytesIO(processed_image)),
+                        rekog_portrait = RekognitionImage(processed_image.encoded('JPEG'),
                                                           st.session_state["file_uploader_key"], client)
-                        st.session_state['face_detected'] = rekog_portrait.detect_faces()
+                        face_future = get_analysis_executor().submit(rekog_portrait.detect_faces)
+                        st.session_state['face_detected'] = face_future.result(timeout=ANALYSIS_TIMEOUT)
+                    except FutureTimeoutError:
+                        st.error("Face detection timed out. Please try again.")
+                        st.session_state['face_detected'] = False
                     except Exception as e:
                         st.error(f"Face detection error: {str(e)}")
                         st.session_state['face_detected'] = False
+                    if SPECULATIVE_DESCRIBE and st.session_state['face_detected']:
+                        st.session_state['describe_future'] = start_describe_picture(processed_image)
                 else:
                     st.session_state['face_detected'] = False
 
@@ -465,9 +659,9 @@ if st.session_state['authenticated']:
                 st.session_state['filename'] = "photo-" + str(uuid.uuid4())[-17:] + ".jpeg"
 
             st.header("Uploaded image")
-            with Image.open(st.session_state['img_file_buffer']) as image:
-                image = ImageOps.exif_transpose(image)
-                st.image(image, use_column_width="always")
+            image = st.session_state.get('normalized_image')
+            if image is not None:
+                st.image(image.image, use_column_width="always")
 
             if st.button('Clear Image', use_container_width=True):
                 clear_session_state()
@@ -475,7 +669,6 @@ if st.session_state['authenticated']:
                 st.rerun()
 
             filename = st.session_state['filename']
-            input_image_name = local_path + "input/" + filename
 
             if st.button('Describe picture', key="describe_picture", on_click=describe_picture, use_container_width=True):
                 if st.session_state["response_body"]:
@@ -504,24 +697,17 @@ if st.session_state['authenticated']:
                     st.session_state["avatar_final_image"] = ""
                     st.warning("No face detected in the uploaded image. Please try again with a different image.")
                 else:
-                    with open(scifi_presets_json, 'r', encoding='utf-8') as scifi_json_file:
-                        scifi_presets = json.load(scifi_json_file)
-                    with open(football_presets_json, 'r', encoding='utf-8') as football_json_file:
-                        football_presets = json.load(football_json_file)
-                    with open(sports_presets_json, 'r', encoding='utf-8') as sports_json_file:
-                        sports_presets = json.load(sports_json_file)
-
-                    with open(negative_prompt_file, 'r', encoding='utf-8') as negative_prompt:
-                        negative_prompt_data = json.load(negative_prompt)
+                    template_registry = get_template_registry()
+                    scifi_presets, scifi_presets_by_key = template_registry.presets(scifi_presets_json, 'Element_Preset')
+                    football_presets, football_presets_by_key = template_registry.presets(football_presets_json, 'Club')
+                    sports_presets, sports_presets_by_key = template_registry.presets(sports_presets_json, 'Club')
 
-                    # Create a dictionary from the data for quick access
-                    negative_prompt_dict = {item['negative_prompt']: item['prompt'] for item in negative_prompt_data}
+                    # Dictionary for quick access
+                    negative_prompt_dict = template_registry.negative_prompts()
 
                     # Set negative prompt default
                     negative_prompt = negative_prompt_dict.get('default', '')
 
-                    seed = int(random.random() * 1e8)
-
                     option = st.selectbox(
                         'Choose a preset style',
                         ['Sci-Fi', 'EURO 2024', 'Other Sports'])
@@ -535,7 +721,7 @@ if st.session_state['authenticated']:
                                                  horizontal=True,
                                                  index=index_option,
                                                  label_visibility="collapsed")
-                        selected_preset = next((item for item in scifi_presets if item['Element_Preset'] == avatar_preset), None)
+                        selected_preset = scifi_presets_by_key.get(avatar_preset)
                         scifi_negative_prompt = negative_prompt_dict.get('scifi', '')
 
                     if "EURO 2024" in option:
@@ -547,7 +733,7 @@ if st.session_state['authenticated']:
                                                  index=index_option,
                                                  label_visibility="collapsed")
 
-                        selected_preset = next((item for item in football_presets if item['Club'] == avatar_preset), None)
+                        selected_preset = football_presets_by_key.get(avatar_preset)
                         football_negative_prompt = negative_prompt_dict.get('football', '')
 
                     if "Other Sports" in option:
@@ -559,7 +745,7 @@ if st.session_state['authenticated']:
                                                  index=index_option,
                                                  label_visibility="collapsed")
 
-                        selected_preset = next((item for item in sports_presets if item['Club'] == avatar_preset), None)
+                        selected_preset = sports_presets_by_key.get(avatar_preset)
                         sports_negative_prompt = negative_prompt_dict.get('other sports', '')
 
                     preset_prompt = selected_preset['prompt'] if selected_preset else "No prompt found."
@@ -624,38 +810,42 @@ if st.session_state['authenticated']:
                     )
 
 
-                    if st.session_state.avatar_creation_in_progress:
+                    job_manager = get_job_manager()
+                    if st.session_state.avatar_creation_in_progress and st.session_state.get("avatar_job_id") is None:
                         st.session_state["glb_photo_name"] = "avatar-" + str(uuid.uuid4())[-17:] + ".jpeg"
                         st.session_state["avatar_final_image"] = None
-                        with st.spinner('Generating avatar...'):
-                            try:
-                                images = parse_workflow(
-                                    prompt,
-                                    negative_prompt,
-                                    seed,
-                                    input_image_name,
-                                    filename,
-                                    comfyui_session
-                                )
-                                # Process images...
-                                for node_id in images:
-                                    for image_output in images[node_id]:
-                                        try:
-                                            image_data = Image.open(io.BytesIO(image_output))
-                                            st.session_state["avatar_final_image"] = image_data
-                                            if image_moderation:
-                                                rekog_img = RekognitionImage(
-                                                    st.session_state["avatar_final_image"],
-                                                    st.session_state["glb_photo_name"],
-                                                    client
-                                                )
-                                                st.session_state["rekog_img_labels"] = rekog_img.detect_moderation_labels()
-                                                logger.info(f"Moderation labels detected: {st.session_state['rekog_img_labels']}")
-                                        except Exception as e:
-                                            logger.error(f"Error processing image: {e}")
-                            finally:
-                                # Reset the flag after processing
-                                st.session_state.avatar_creation_in_progress = False
+                        st.session_state["avatar_job_id"] = job_manager.submit(
+                            generate_avatar,
+                            get_comfyui_client(),
+                            get_backend_pool(),
+                            get_analysis_executor(),
+                            get_result_cache(),
+                            image,
+                            build_workflow(prompt, negative_prompt, st.session_state["seed"], filename),
+                            filename,
+                            comfyui_session,
+                            client_id
+                        )
+
+                    if st.session_state.get("avatar_job_id") is not None:
+                        job = job_manager.get(st.session_state["avatar_job_id"])
+                        if job is None:
+                            st.session_state["avatar_job_id"] = None
+                            st.session_state.avatar_creation_in_progress = False
+                            st.error("Avatar job expired. Please try again.")
+                        elif not job.finished:
+                            # Check the job again shortly without blocking the script thread
+                            st.info(f"Generating avatar... ({job.state})")
+                            st_autorefresh(interval=1000, key="avatar_job_refresh")
+                        else:
+                            # Reset the flag after processing
+                            st.session_state["avatar_job_id"] = None
+                            st.session_state.avatar_creation_in_progress = False
+                            if job.state == "failed":
+                                st.error(job.error)
+                            else:
+                                st.session_state["avatar_final_image"] = job.image
+                                st.session_state["rekog_img_labels"] = job.labels
                                 st.rerun()
 
                 with col3:
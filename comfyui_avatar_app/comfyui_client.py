@@ -0,0 +1,492 @@
+"""
+ComfyUI HTTP and websocket client, backend routing and the result cache.
+Nothing in here imports Streamlit, avatar_app.py keeps the process-wide instances in st.cache_resource.
+"""
+import copy
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+import websocket
+from botocore.exceptions import ClientError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+class AvatarGenerationError(Exception):
+    """Raised by the generation job with a message that can be shown to the user."""
+
+class ComfyUIRetry(Retry):
+    """Retries GET on 502/503 and read errors. POST is only retried on 503 and connection errors:
+    the ALB answers 503 when it has no healthy target, so the request never reached ComfyUI,
+    while after a 502 or a read error the prompt may already be queued."""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() == "POST":
+            return status_code == 503
+        return super().is_retry(method, status_code, has_retry_after)
+
+def comfyui_http_session(pool_size, retries):
+    # One keep-alive connection pool per process, shared by all Streamlit sessions
+    retry = ComfyUIRetry(
+        total=retries,
+        backoff_factor=0.5,
+        status_forcelist=[502, 503],  # ALB target still warming up
+        allowed_methods=["GET"],
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    http_session = requests.Session()
+    http_session.mount("http://", adapter)
+    http_session.mount("https://", adapter)
+    return http_session
+
+def pool_stats(http_session):
+    # urllib3 counts new connections and requests per host pool, the difference is keep-alive reuse
+    stats = {"connections": 0, "requests": 0}
+    for adapter in set(http_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools.get(pool_key)
+            if pool is not None:
+                stats["connections"] += pool.num_connections
+                stats["requests"] += pool.num_requests
+    stats["reused"] = stats["requests"] - stats["connections"]
+    return stats
+
+def get_output_nodes(prompt_data):
+    return [node_id for node_id, node in prompt_data.items() if node["class_type"] == "PreviewImage"]
+
+def use_websocket_output(prompt_data, output_nodes):
+    # ComfyUI ships SaveImageWebsocket in custom_nodes/websocket_image_save.py. It pushes the
+    # encoded image over the websocket instead of writing it to the output dir on EFS.
+    for node_id in output_nodes:
+        prompt_data[node_id] = {
+            "inputs": {"images": prompt_data[node_id]["inputs"]["images"]},
+            "class_type": "SaveImageWebsocket"
+        }
+    return prompt_data
+
+def wait_for_prompt_ws(ws, prompt_id, timeout, output_images=None):
+    """Blocks until ComfyUI reports the prompt as finished. Returns True on completion,
+    False on execution error and None if the websocket could not deliver a result.
+    Binary image frames sent by a SaveImageWebsocket node are appended to output_images[node_id]."""
+    deadline = time.time() + timeout
+    current_node = None
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logger.warning(f"Timeout waiting for websocket completion of {prompt_id}")
+                return None
+            ws.settimeout(remaining)
+            message = ws.recv()
+            if not isinstance(message, str):
+                # 8 byte header (event type, image format) followed by the encoded image.
+                # Frames from other nodes are latent previews and are ignored.
+                if output_images is not None and current_node in output_images:
+                    output_images[current_node].append(message[8:])
+                continue
+            event = json.loads(message)
+            data = event.get('data', {})
+            if data.get('prompt_id') != prompt_id:
+                continue
+            if event['type'] == 'executing':
+                current_node = data.get('node')
+                if current_node is None:
+                    return True
+            if event['type'] == 'execution_error':
+                logger.error(f"ComfyUI execution error: {data.get('exception_message')}")
+                return False
+    except (websocket.WebSocketException, OSError, ValueError) as e:
+        logger.warning(f"ComfyUI websocket failed while waiting for {prompt_id}: {e}")
+        return None
+
+class ComfyUIClient:
+    """Talks to one or more ComfyUI backends (host:port) over a shared requests.Session.
+    Every call takes the backend explicitly, default_endpoint is used when it is None."""
+
+    def __init__(self, default_endpoint, http_session, timeout, completion_mode="websocket",
+                 output_mode="websocket"):
+        self.default_endpoint = default_endpoint
+        self.http_session = http_session
+        self.timeout = timeout
+        # "websocket" waits for ComfyUI's execution events, "polling" only polls history/{prompt_id}
+        self.completion_mode = completion_mode
+        # "websocket" swaps the PreviewImage node for SaveImageWebsocket and receives the PNG as binary frames
+        self.output_mode = output_mode
+        self._node_types = {}
+
+    def request(self, endpoint, method='GET', data=None, headers=None, files=None, params=None, cookies=None,
+                backend=None, timeout=None):
+        url = f"http://{backend or self.default_endpoint}/{endpoint}"
+        timeout = timeout or self.timeout
+        try:
+            if method == 'GET':
+                response = self.http_session.get(url, headers=headers, params=params, cookies=cookies,
+                                                 timeout=timeout)
+                logger.info(f"ComfyUI GET {endpoint} response status: {response.status_code}")
+            elif method == 'POST':
+                response = self.http_session.post(url, data=data, headers=headers, files=files, params=params,
+                                                  cookies=cookies, timeout=timeout)
+                logger.info(f"ComfyUI POST {endpoint} response status: {response.status_code}")
+            else:
+                raise ValueError(f"Unsupported method {method}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"ComfyUI connection pool stats: {pool_stats(self.http_session)}")
+            response.raise_for_status()
+            if response.headers.get('Content-Type', '').startswith('application/json'):
+                logger.info(f"Returning JSON response for {endpoint}")
+                return response.json()
+            else:
+                logger.info(f"Returning content response for {endpoint}")
+                return response.content
+        except requests.exceptions.HTTPError as e:
+            logger.error(f"HTTP error: {e.response.status_code} - {e.response.text}")
+            return None
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error making request to ComfyUI: {e}")
+            return None
+
+    def has_node(self, class_type):
+        """Whether the ComfyUI behind default_endpoint has the node type installed. Only answers
+        from ComfyUI are remembered, a failed lookup is retried on the next call."""
+        if class_type not in self._node_types:
+            response = self.request(f'object_info/{class_type}')
+            if not isinstance(response, dict):
+                return False
+            self._node_types[class_type] = class_type in response
+            if not self._node_types[class_type]:
+                logger.warning(f"ComfyUI has no {class_type} node")
+        return self._node_types[class_type]
+
+    def upload_image(self, input_file, name, comfyui_session, backend, image_type="input", overwrite=False):
+        input_file.seek(0)
+        files = {
+            'image': (name, input_file, 'image/jpeg'),
+        }
+        data = {
+            'type': image_type,
+            'overwrite': str(overwrite).lower()
+        }
+        cookies = {'COMFY-SESSION': comfyui_session}
+        return self.request('upload/image', method='POST', data=data, files=files, cookies=cookies,
+                            backend=backend)
+
+    def queue_prompt(self, prompt_data, comfyui_session, client_id, backend):
+        data = {"prompt": prompt_data, "client_id": client_id}
+        cookies = {'COMFY-SESSION': comfyui_session}
+        logger.info(f"Queueing prompt with data: {data}")
+        return self.request('prompt',
+                            method='POST',
+                            data=json.dumps(data).encode("utf-8"),
+                            cookies=cookies,
+                            backend=backend)
+
+    def get_history(self, prompt_id, comfyui_session, backend):
+        cookies = {'COMFY-SESSION': comfyui_session}
+        logger.info(f"get_history prompt_id: {prompt_id}")
+        logger.info(f"get_history comfyui_session: {comfyui_session}")
+        response = self.request(f'history/{prompt_id}',
+                                method='GET',
+                                cookies=cookies,
+                                backend=backend)
+        logger.info(f"get_history response: {response}")
+        return response
+
+    def get_image(self, filename, subfolder, folder_type, comfyui_session, backend):
+        params = {"filename": filename, "subfolder": subfolder, "type": folder_type}
+        cookies = {'COMFY-SESSION': comfyui_session}
+        return self.request('view',
+                            method='GET',
+                            params=params,
+                            cookies=cookies,
+                            backend=backend)
+
+    def open_websocket(self, comfyui_session, client_id, backend, timeout):
+        ws_url = f"ws://{backend or self.default_endpoint}/ws?clientId={client_id}"
+        try:
+            ws = websocket.WebSocket()
+            ws.connect(ws_url, timeout=timeout, cookie=f"COMFY-SESSION={comfyui_session}")
+            logger.info(f"Connected to ComfyUI websocket: {ws_url}")
+            return ws
+        except (websocket.WebSocketException, OSError) as e:
+            logger.warning(f"Could not connect to ComfyUI websocket, falling back to polling: {e}")
+            return None
+
+    def get_images(self, prompt_data, comfyui_session, client_id, backend, overall_timeout=20):
+        # overall_timeout: Total timeout in seconds
+        initial_wait = 2  # Initial wait before first check
+        check_interval = 1.5  # Interval between checks
+        extended_interval = 3  # Extended interval for later checks
+        switch_to_extended_at = 7.5  # Time to switch to extended interval
+
+        # Subscribe before queueing so the completion event cannot be missed
+        ws = None
+        if self.completion_mode == "websocket":
+            ws = self.open_websocket(comfyui_session, client_id, backend, timeout=5)
+        # Websocket output needs a live websocket, otherwise keep the PreviewImage node for /view
+        ws_output = ws is not None and self.output_mode == "websocket"
+        output_nodes = get_output_nodes(prompt_data)
+        preview_prompt_data = prompt_data
+        if ws_output:
+            prompt_data = use_websocket_output(copy.deepcopy(prompt_data), output_nodes)
+
+        try:
+            response = self.queue_prompt(prompt_data, comfyui_session, client_id, backend)
+            if response is None:
+                logger.error("Failed to queue prompt.")
+                raise AvatarGenerationError("Failed to queue prompt.")
+
+            prompt_id = response.get('prompt_id')
+
+            output_images = {}
+
+            start_time = time.time()
+
+            logger.info(f"Avatar creation triggered, prompt_id: {prompt_id}")
+
+            def attempt_fetch_images():
+                nonlocal output_images
+                try:
+                    history = self.get_history(prompt_id, comfyui_session, backend)
+                    if history and prompt_id in history:
+                        for node_id, node_output in history[prompt_id].get('outputs', {}).items():
+                            if 'images' in node_output:
+                                images_output = []
+                                for image_info in node_output['images']:
+                                    image_data = self.get_image(
+                                        image_info['filename'],
+                                        image_info['subfolder'],
+                                        image_info['type'],
+                                        comfyui_session,
+                                        backend
+                                    )
+                                    images_output.append(image_data)
+                                output_images[node_id] = images_output
+                    return bool(output_images)
+                except Exception as e:
+                    logger.error(f"Failed to fetch images: {e}")
+                    return False
+
+            ws_result = None
+            if ws:
+                ws_images = {node_id: [] for node_id in output_nodes} if ws_output else None
+                ws_result = wait_for_prompt_ws(ws, prompt_id, overall_timeout, ws_images)
+                if ws_result and ws_images and any(ws_images.values()):
+                    output_images.update({node_id: images for node_id, images in ws_images.items() if images})
+                    logger.info('Images fetched successfully.')
+                elif ws_result and attempt_fetch_images():
+                    logger.info('Images fetched successfully.')
+                elif ws_result is False:
+                    raise AvatarGenerationError("Avatar generation failed. Please try again")
+
+            if ws_result is None and ws_output:
+                # SaveImageWebsocket images never show up in /history, polling for them cannot succeed.
+                # Queue the PreviewImage graph instead: it runs after the lost prompt on the same backend,
+                # so ComfyUI serves every upstream node from its cache and only re-runs the output nodes.
+                if overall_timeout - (time.time() - start_time) <= initial_wait:
+                    raise AvatarGenerationError("Failed to fetch the avatar. Please try again.")
+                logger.warning(f"Lost the websocket output of {prompt_id}, queueing it again with PreviewImage")
+                response = self.queue_prompt(preview_prompt_data, comfyui_session, client_id, backend)
+                if response is None:
+                    raise AvatarGenerationError("Failed to queue prompt.")
+                prompt_id = response.get('prompt_id')
+
+            if ws_result is None:
+                # Polling fallback
+                elapsed_time = time.time() - start_time
+                if elapsed_time < initial_wait:
+                    time.sleep(initial_wait - elapsed_time)
+
+                while True:
+                    elapsed_time = time.time() - start_time
+
+                    if elapsed_time > overall_timeout:
+                        logger.warning(f"Timeout reached while waiting for images of {prompt_id}")
+                        break
+
+                    if attempt_fetch_images():
+                        logger.info('Images fetched successfully.')
+                        break
+
+                    if elapsed_time < switch_to_extended_at:
+                        interval = check_interval
+                    else:
+                        interval = extended_interval
+
+                    time.sleep(interval)
+
+            # Final attempt to fetch images if not already fetched
+            if not output_images:
+                attempt_fetch_images()
+
+            if not output_images:
+                raise AvatarGenerationError("Failed to fetch the avatar. Please try again.")
+
+            return output_images
+        finally:
+            if ws:
+                ws.close()
+
+def target_group_endpoints(elbv2_client, target_group_arn):
+    """Returns host:port of the healthy targets registered in the ALB target group. The ComfyUI
+    tasks are registered by IP, so these are the tasks themselves, not the load balancer nodes."""
+    try:
+        response = elbv2_client.describe_target_health(TargetGroupArn=target_group_arn)
+    except ClientError as e:
+        logger.warning(f"ComfyUI backend discovery failed for {target_group_arn}: {e}")
+        return []
+    return sorted(f"{description['Target']['Id']}:{description['Target']['Port']}"
+                  for description in response['TargetHealthDescriptions']
+                  if description['TargetHealth']['State'] == 'healthy')
+
+class ComfyUIBackend:
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.healthy = True
+        self.queue_remaining = 0
+        self.in_flight = 0  # prompts routed here since the last queue poll
+
+    @property
+    def load(self):
+        return self.queue_remaining + self.in_flight
+
+class ComfyUIBackendPool:
+    """Routes each prompt to the healthy ComfyUI backend with the shortest queue.
+    Queue depth is read from GET /prompt (exec_info.queue_remaining) at most every refresh_interval seconds.
+    The polls should go through a client without retries, a backend that does not answer is simply unhealthy."""
+
+    def __init__(self, client, endpoints, refresh_interval, discover=None):
+        self._client = client
+        self._backends = {endpoint: ComfyUIBackend(endpoint) for endpoint in endpoints}
+        self._discover = discover
+        self._refresh_interval = refresh_interval
+        self._last_refresh = 0
+        self._lock = threading.Lock()
+
+    def _poll(self, backend):
+        response = self._client.request('prompt', backend=backend.endpoint, timeout=(1, 2))
+        if isinstance(response, dict):
+            backend.queue_remaining = response.get('exec_info', {}).get('queue_remaining', 0)
+            backend.healthy = True
+        else:
+            backend.healthy = False
+        backend.in_flight = 0
+
+    def refresh(self, force=False):
+        with self._lock:
+            if not force and time.time() - self._last_refresh < self._refresh_interval:
+                return
+            self._last_refresh = time.time()
+            if self._discover:
+                discovered = self._discover()
+                if discovered:
+                    self._backends = {endpoint: self._backends.get(endpoint) or ComfyUIBackend(endpoint)
+                                      for endpoint in discovered}
+            backends = list(self._backends.values())
+        with ThreadPoolExecutor(max_workers=len(backends) or 1) as executor:
+            list(executor.map(self._poll, backends))
+        logger.info("ComfyUI backends: " + ", ".join(
+            f"{b.endpoint} healthy={b.healthy} queue={b.queue_remaining}" for b in backends))
+
+    def healthy_backends(self):
+        self.refresh()
+        return [backend for backend in self._backends.values() if backend.healthy]
+
+    def acquire(self):
+        """Returns the endpoint of the least-loaded healthy backend, or None if all are down."""
+        healthy = self.healthy_backends()
+        if not healthy:
+            return None
+        with self._lock:
+            backend = min(healthy, key=lambda b: b.load)
+            backend.in_flight += 1
+            return backend.endpoint
+
+class ResultCache:
+    """Caches generated avatars (PNG bytes and moderation labels) by content hash.
+    An LRU memory tier is backed by an optional S3 tier, and identical requests that are
+    already running are joined instead of being queued a second time."""
+
+    def __init__(self, max_entries, s3_client=None, s3_bucket=None, s3_prefix=None):
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._max_entries = max_entries
+        self._s3_client = s3_client
+        self._s3_bucket = s3_bucket
+        self._s3_prefix = s3_prefix
+
+    def _get_memory(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        return None
+
+    def _put_memory(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_s3(self, key):
+        if not self._s3_prefix:
+            return None
+        try:
+            response = self._s3_client.get_object(Bucket=self._s3_bucket, Key=f"{self._s3_prefix}{key}.png")
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                logger.warning(f"Result cache S3 lookup failed: {e}")
+            return None
+        labels = json.loads(response['Metadata'].get('moderation-labels', '[]'))
+        return response['Body'].read(), labels
+
+    def _put_s3(self, key, value):
+        if not self._s3_prefix:
+            return
+        image_bytes, labels = value
+        try:
+            self._s3_client.put_object(Bucket=self._s3_bucket, Key=f"{self._s3_prefix}{key}.png", Body=image_bytes,
+                                       ContentType='image/png', Metadata={'moderation-labels': json.dumps(labels)})
+        except ClientError as e:
+            logger.warning(f"Result cache S3 store failed: {e}")
+
+    def get_or_compute(self, key, compute):
+        value = self._get_memory(key)
+        if value is not None:
+            logger.info(f"Result cache memory hit for {key}")
+            return value
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+        if not owner:
+            logger.info(f"Joining in-flight request for {key}")
+            return future.result()
+        try:
+            value = self._get_s3(key)
+            if value is not None:
+                logger.info(f"Result cache S3 hit for {key}")
+            else:
+                value = compute()
+                self._put_s3(key, value)
+            self._put_memory(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
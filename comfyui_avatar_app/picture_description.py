@@ -0,0 +1,49 @@
+"""
+Bedrock description of an uploaded photo, run on the shared analysis executor.
+Nothing in here imports Streamlit, avatar_app.py keeps the future in session state.
+"""
+import base64
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+DESCRIBE_MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+
+def describe_image(image_bytes, bedrock_client):
+    encoded_image = base64.b64encode(image_bytes).decode('utf8')
+
+    body = json.dumps({
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 500,
+        "messages": [{
+            "role": "user",
+            "content": [{
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": "image/jpeg",
+                    "data": encoded_image,
+                },
+            },
+                {"type": "text", "text": "What is in this image?"}, ],
+        }]
+    })
+    response = bedrock_client.invoke_model(
+        modelId=DESCRIBE_MODEL_ID,
+        body=body
+    )
+    return json.loads(response.get("body").read())
+
+def start_describe(executor, bedrock_client, normalized_image):
+    # The JPEG is encoded on the worker thread, not in the script run
+    return executor.submit(lambda: describe_image(normalized_image.encoded('JPEG'), bedrock_client))
+
+def cancel_describe(future):
+    """Drops a description nobody is going to read. Returns True if the Bedrock call was never made."""
+    if future is None:
+        return False
+    cancelled = future.cancel()
+    if cancelled:
+        logger.info("Cancelled speculative picture description")
+    return cancelled
@@ -1,16 +1,42 @@
 import streamlit as st
 import boto3
-from PIL import Image
-import io, os, time
+import os, time, json, html, base64
 from streamlit_cognito_auth import CognitoAuthenticator
 from streamlit_extras.stylable_container import stylable_container
-from streamlit_autorefresh import st_autorefresh
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor
+from image_urls import SignedUrlCache, url_signer
+from gallery_index import GalleryIndex, ImageCache
+import gallery_images
 
 st.set_page_config(layout="wide")
 
-s3_client = boto3.client('s3')
+# Parallel image downloads per page, the botocore connection pool is sized to match
+gallery_fetch_concurrency = int(os.environ.get("GALLERY_FETCH_CONCURRENCY", "16"))
+s3_client = boto3.client('s3', config=Config(max_pool_connections=gallery_fetch_concurrency))
 bucket_name = os.environ.get("S3_BUCKET")
 bucket_prefix = os.environ.get("S3_BUCKET_PREFIX")
+# Every add/remove of an avatar is recorded as a small event object under this prefix
+gallery_index_prefix = os.environ.get("GALLERY_INDEX_PREFIX", "gallery-index/events/")
+gallery_index_refresh = float(os.environ.get("GALLERY_INDEX_REFRESH", "5"))
+# Seconds between the cheap in-process checks of a gallery screen for new avatars
+gallery_change_poll = float(os.environ.get("GALLERY_CHANGE_POLL", "2"))
+# Small renditions are stored as <thumbnail_prefix><size>/<file name>.<jpeg|webp>
+thumbnail_prefix = os.environ.get("THUMBNAIL_PREFIX", "thumbnails/")
+thumbnail_sizes = (128, 256, 512)
+# Used to estimate the tile width for a given number of columns
+gallery_screen_width = int(os.environ.get("GALLERY_SCREEN_WIDTH", "1920"))
+# Only one page of the gallery is downloaded and rendered per run
+gallery_page_size = int(os.environ.get("GALLERY_PAGE_SIZE", "50"))
+# Encoded image bytes are kept in memory up to this size and revalidated with their ETag
+gallery_cache_bytes = int(os.environ.get("GALLERY_CACHE_MB", "256")) * 1024 * 1024
+gallery_cache_revalidate = float(os.environ.get("GALLERY_CACHE_REVALIDATE", "120"))
+# proxy: images are sent through Streamlit, presigned/cloudfront: the browser loads them from signed URLs
+gallery_image_mode = os.environ.get("GALLERY_IMAGE_MODE", "proxy")
+gallery_url_ttl = int(os.environ.get("GALLERY_URL_TTL", "3600"))
+# Streamlit passes JPEG through to the browser as is, browsers loading signed URLs get the smaller WebP
+thumbnail_format = "JPEG" if gallery_image_mode == "proxy" else "WEBP"
 pool_id = os.environ["COGNITO_POOL_ID"]
 app_client_id = os.environ["COGNITO_APP_CLIENT_ID"]
 app_client_secret = os.environ["COGNITO_APP_CLIENT_SECRET"]
@@ -24,10 +50,33 @@ authenticator = CognitoAuthenticator(
 
 cognito_client = boto3.client('cognito-idp')
 
+def token_expiry(token):
+    # Only the exp claim is read, the token itself was verified at login and by Cognito
+    payload = token.split('.')[1]
+    claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    return claims['exp']
+
+@st.cache_resource
+def get_user_attribute_cache():
+    return {}
+
+def get_user_attributes():
+    """UserAttributes of the logged in user, fetched once per access token until it expires."""
+    access_token = authenticator.get_credentials().access_token
+    cache = get_user_attribute_cache()
+    cached = cache.get(access_token)
+    if cached and cached[1] > time.time():
+        return cached[0]
+    response = cognito_client.get_user(AccessToken=access_token)
+    now = time.time()
+    for token, (_, expires_at) in list(cache.items()):
+        if expires_at <= now:
+            cache.pop(token, None)
+    cache[access_token] = (response['UserAttributes'], token_expiry(access_token))
+    return response['UserAttributes']
+
 def get_user_profile():
-    credentials = authenticator.get_credentials()
-    response = cognito_client.get_user(AccessToken=credentials.access_token)
-    user_attributes = response['UserAttributes']
+    user_attributes = get_user_attributes()
     
     for attribute in user_attributes:
         if attribute['Name'] == "profile":
@@ -41,59 +90,169 @@ def is_authorized_profile():
 def is_admin_profile():
     return get_user_profile() == 'admin'
 
-def get_user_attributes():
-    credentials = authenticator.get_credentials()
-    response = cognito_client.get_user(AccessToken=credentials.access_token)
-    return response['UserAttributes']
-
 def logout():
     authenticator.cookie_manager.reset_credentials()
     authenticator.logout()
     st.stop()
     
 def get_authenticated_status():
+    # Logging in verifies the token and calls Cognito, once per session is enough until it expires
+    credentials = authenticator.get_credentials()
+    if st.session_state.get('authenticated') and credentials and token_expiry(credentials.access_token) > time.time():
+        return True
     is_logged_in = authenticator.login()
     return is_logged_in
 
-def move_image(bucket, source_key, dest_key):
-    copy_source = {'Bucket': bucket, 'Key': source_key}
-    s3_client.copy_object(CopySource=copy_source, Bucket=bucket, Key=dest_key)
-    s3_client.delete_object(Bucket=bucket, Key=source_key)
+def thumbnail_key(key, size):
+    return gallery_images.thumbnail_key(thumbnail_prefix, key, size, thumbnail_format)
+
+def thumbnail_size_for(cols_per_row):
+    # Smallest rendition that still covers the tile, None means the full image is needed
+    tile_width = gallery_screen_width / cols_per_row
+    return next((size for size in thumbnail_sizes if size >= tile_width), None)
+
+def create_thumbnails(bucket, key, image_content):
+    renditions = gallery_images.encode_thumbnails(image_content, thumbnail_sizes, thumbnail_format)
+    for size, rendition in renditions.items():
+        response = s3_client.put_object(Bucket=bucket, Key=thumbnail_key(key, size), Body=rendition,
+                                        ContentType=gallery_images.THUMBNAIL_FORMATS[thumbnail_format][1])
+        get_image_cache().add(thumbnail_key(key, size), response['ETag'], rendition)
+    return renditions
+
+def move_images(bucket, moves):
+    """Moves (source, destination) pairs, returns the pairs that were moved."""
+    url_cache = get_signed_url_cache(bucket) if gallery_image_mode != "proxy" else None
+    moved, failed = gallery_images.move_objects(s3_client, get_fetch_executor(), get_gallery_index(bucket), get_image_cache(),
+                                                moves, url_cache)
+    for (source_key, _), e in failed:
+        st.error(f"Could not move {source_key}: {e}")
+    return moved
+
+def ensure_thumbnails(bucket, key):
+    # Older avatars were shared before thumbnails existed
+    try:
+        s3_client.head_object(Bucket=bucket, Key=thumbnail_key(key, thumbnail_sizes[0]))
+    except ClientError:
+        create_thumbnails(bucket, key, load_image_from_s3(bucket, key))
+
+def promote_images(bucket, keys):
+    moved = move_images(bucket, [(key, f'gallery/{key.split("/")[-1]}') for key in keys])
+    executor = get_fetch_executor()
+    list(executor.map(lambda move: ensure_thumbnails(bucket, move[1]), moved))
+
+def moderate_images(bucket, keys):
+    move_images(bucket, [(key, f'{bucket_prefix}{key.split("/")[-1]}') for key in keys])
+
+@st.cache_resource
+def get_image_cache():
+    return ImageCache(s3_client, gallery_cache_bytes, gallery_cache_revalidate)
 
-@st.cache_data(ttl=120)
 def load_image_from_s3(bucket, key):
-    response = s3_client.get_object(Bucket=bucket, Key=key)
-    image_content = response['Body'].read()
-    image = Image.open(io.BytesIO(image_content))
-    return image
+    return get_image_cache().get(bucket, key)
+
+def load_thumbnail_from_s3(bucket, key, size):
+    cache = get_image_cache()
+    try:
+        return cache.get(bucket, thumbnail_key(key, size))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+    # Built lazily for avatars that have no thumbnails yet
+    return create_thumbnails(bucket, key, load_image_from_s3(bucket, key))[size]
+
+def load_gallery_image(bucket, key, cols_per_row):
+    size = thumbnail_size_for(cols_per_row)
+    if size is None:
+        return load_image_from_s3(bucket, key)
+    return load_thumbnail_from_s3(bucket, key, size)
+
+@st.cache_resource
+def get_signed_url_cache(bucket):
+    if gallery_image_mode == "cloudfront":
+        sign = url_signer(s3_client, bucket, os.environ["GALLERY_CLOUDFRONT_DOMAIN"],
+                          os.environ["GALLERY_CLOUDFRONT_KEY_ID"], os.environ["GALLERY_CLOUDFRONT_PRIVATE_KEY"])
+    else:
+        sign = url_signer(s3_client, bucket)
+    return SignedUrlCache(sign, gallery_url_ttl)
+
+@st.cache_resource
+def get_known_thumbnails():
+    return set()
+
+def gallery_image_url(bucket, key, cols_per_row):
+    size = thumbnail_size_for(cols_per_row)
+    if size is None:
+        return get_signed_url_cache(bucket).url(key)
+    known = get_known_thumbnails()
+    if key not in known:
+        # Checked once per process, avatars shared before thumbnails existed get them here
+        try:
+            s3_client.head_object(Bucket=bucket, Key=thumbnail_key(key, size))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                raise
+            create_thumbnails(bucket, key, load_image_from_s3(bucket, key))
+        known.add(key)
+    return get_signed_url_cache(bucket).url(thumbnail_key(key, size))
+
+def render_image(container, image):
+    if image is None:
+        container.caption("⚠️ Image unavailable")
+    elif gallery_image_mode == "proxy":
+        container.image(image, use_column_width=True)
+    else:
+        container.markdown(f'<img src="{html.escape(image)}" style="width: 100%;">', unsafe_allow_html=True)
+
+@st.cache_resource
+def get_gallery_index(bucket):
+    return GalleryIndex(s3_client, bucket, [bucket_prefix, 'gallery/'], gallery_index_prefix, gallery_index_refresh)
 
-@st.cache_data(ttl=60)
 def list_images_in_bucket(bucket, prefix):
-    images = []
-    continuation_token = None
-    while True:
-        if continuation_token:
-            response = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix, ContinuationToken=continuation_token)
-        else:
-            response = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix)
-        
-        images.extend([item['Key'] for item in response.get('Contents', []) if item['Key'].endswith(('.png', '.jpg', '.jpeg'))])
-        
-        if response.get('IsTruncated'):
-            continuation_token = response.get('NextContinuationToken')
-        else:
-            break
-    return images
+    return get_gallery_index(bucket).images(prefix)
+
+@st.cache_resource
+def get_fetch_executor():
+    return ThreadPoolExecutor(max_workers=gallery_fetch_concurrency, thread_name_prefix="gallery-fetch")
+
+def prefetch_images(keys, cols_per_row):
+    """Loads the images (or their signed URLs) on a bounded thread pool,
+    yields (index, image) in completion order."""
+    load = load_gallery_image if gallery_image_mode == "proxy" else gallery_image_url
+    return gallery_images.prefetch(get_fetch_executor(), lambda key: load(bucket_name, key, cols_per_row), keys)
+
+def show_full_image(key):
+    st.session_state['full_image_key'] = key
+
+def display_full_image():
+    key = st.session_state.get('full_image_key')
+    if key:
+        try:
+            if gallery_image_mode == "proxy":
+                image = load_image_from_s3(bucket_name, key)
+            else:
+                image = get_signed_url_cache(bucket_name).url(key)
+        except (ClientError, BotoCoreError) as e:
+            st.error(f"Could not load {key}: {e}")
+            image = None
+        render_image(st, image)
+        if st.button("close", key="close_full_image", use_container_width=True):
+            st.session_state['full_image_key'] = None
+            st.rerun()
 
 def display_gallery(images, cols_per_row, is_admin=False):
     col_index = 0
     cols = st.columns(cols_per_row, gap="small")
+    placeholders = []
     for i, image_key in enumerate(images):
         with cols[col_index]:
-            img = load_image_from_s3(bucket_name, image_key)
-            st.image(img, use_column_width=True)
+            # Filled as the downloads complete, see below
+            placeholders.append(st.empty())
+            if thumbnail_size_for(cols_per_row) is not None:
+                # Thumbnails only, the full resolution avatar is fetched on click
+                st.button("🔍", key=f'view_{i}', on_click=show_full_image, args=(image_key,),
+                          use_container_width=True)
             if is_admin:
-                st.caption(image_key)
+                st.checkbox(image_key, key=f'select_{image_key}')
                 
                 if image_key.split("/")[0]+"/" == bucket_prefix:
                     with stylable_container(
@@ -106,10 +265,8 @@ def display_gallery(images, cols_per_row, is_admin=False):
                             }
                             """,
                     ):
-                        if st.button("promote", key=f'promote_{i}', use_container_width=True):
-                            move_image(bucket_name, image_key, f'gallery/{image_key.split("/")[-1]}')
-                            st.session_state['refresh_gallery'] = True
-                            st.rerun()
+                        st.button("promote", key=f'promote_{i}', on_click=promote_images,
+                                  args=(bucket_name, [image_key]), use_container_width=True)
                 
                 if image_key.split("/")[0] == 'gallery':
                     with stylable_container(
@@ -122,23 +279,72 @@ def display_gallery(images, cols_per_row, is_admin=False):
                         }
                         """,
                     ):
-                        if st.button("moderate", key=f'moderate_{i}', use_container_width=True):
-                            move_image(bucket_name, image_key, f'{bucket_prefix}{image_key.split("/")[-1]}')
-                            st.session_state['refresh_gallery'] = True
-                            st.rerun()
+                        st.button("moderate", key=f'moderate_{i}', on_click=moderate_images,
+                                  args=(bucket_name, [image_key]), use_container_width=True)
         col_index = (col_index + 1) % cols_per_row
+
+    for i, img in prefetch_images(images, cols_per_row):
+        render_image(placeholders[i], img)
+
+def selected_images(prefix):
+    return [key[len('select_'):] for key, selected in st.session_state.items()
+            if key.startswith(f'select_{prefix}') and selected]
+
+def apply_to_selection(action, prefix):
+    selected = selected_images(prefix)
+    action(bucket_name, selected)
+    for key in selected:
+        st.session_state[f'select_{key}'] = False
+
+def display_batch_actions():
+    # Like the per-tile buttons, shared avatars can be promoted and gallery avatars moderated
+    to_promote = len(selected_images(bucket_prefix))
+    to_moderate = len(selected_images('gallery/'))
+    promote_col, moderate_col = st.columns(2)
+    promote_col.button(f"promote selected ({to_promote})", key="promote_selected", on_click=apply_to_selection,
+                       args=(promote_images, bucket_prefix), disabled=not to_promote, use_container_width=True)
+    moderate_col.button(f"moderate selected ({to_moderate})", key="moderate_selected", on_click=apply_to_selection,
+                        args=(moderate_images, 'gallery/'), disabled=not to_moderate, use_container_width=True)
+
+def change_page(delta):
+    st.session_state['page'] += delta
+
+def paginate(images):
+    """Renders the page controls and returns the keys of the current page only."""
+    page_count = max(1, -(-len(images) // gallery_page_size))
+    # The gallery may have shrunk since the last run
+    st.session_state['page'] = min(max(st.session_state['page'], 0), page_count - 1)
+    page = st.session_state['page']
+    if page_count > 1:
+        prev_col, label_col, next_col = st.columns([1, 3, 1])
+        prev_col.button("◀ Previous", key="page_prev", on_click=change_page, args=(-1,),
+                        disabled=page == 0, use_container_width=True)
+        label_col.markdown(f"<p style='text-align: center;'>Page {page + 1} of {page_count}</p>",
+                           unsafe_allow_html=True)
+        next_col.button("Next ▶", key="page_next", on_click=change_page, args=(1,),
+                        disabled=page == page_count - 1, use_container_width=True)
+    return images[page * gallery_page_size:(page + 1) * gallery_page_size]
+
+@st.experimental_fragment(run_every=gallery_change_poll)
+def watch_gallery(prefix):
+    # Reruns only this fragment, the whole page is rerun once the prefix has changed
+    if get_gallery_index(bucket_name).version_of(prefix) != st.session_state.get('gallery_version'):
+        st.rerun()
+
 def toggle_auto_refresh():
     st.session_state['auto_refresh'] = not st.session_state.get('auto_refresh', True)
 
 # Main application logic
 if 'authenticated' not in st.session_state:
     st.session_state['authenticated'] = False
-if 'refresh_gallery' not in st.session_state:
-    st.session_state['refresh_gallery'] = False
 if 'cols_per_row' not in st.session_state:
     st.session_state['cols_per_row'] = 10
 if 'auto_refresh' not in st.session_state:
     st.session_state['auto_refresh'] = True
+if 'full_image_key' not in st.session_state:
+    st.session_state['full_image_key'] = None
+if 'page' not in st.session_state:
+    st.session_state['page'] = 0
 
 is_logged_in = get_authenticated_status()
 
@@ -161,9 +367,6 @@ if st.session_state['authenticated']:
     
     if new_cols_per_row != st.session_state['cols_per_row']:
         st.session_state['cols_per_row'] = new_cols_per_row
-        st.session_state['refresh_gallery'] = True
-        list_images_in_bucket.clear()
-        load_image_from_s3.clear()
 
     # Add the auto-refresh toggle button to the sidebar
     auto_refresh_text = "Deactivate" if st.session_state['auto_refresh'] else "Activate"
@@ -175,25 +378,28 @@ if st.session_state['authenticated']:
     st.sidebar.markdown("<h3 style='text-align: center;'>pwd: tbd</h1>", unsafe_allow_html=True)
     st.sidebar.image("qr-code.png")
     
+    if st.session_state['is_admin']:
+        stats = get_image_cache().stats()
+        st.sidebar.caption(f"Image cache: {stats['entries']} images, {stats['bytes'] / 2**20:.1f} MB, "
+                           f"{stats['hits']} hits, {stats['misses']} misses, "
+                           f"{stats['revalidations']} revalidated, {stats['evictions']} evicted")
+
     if st.sidebar.button("Logout", key="logout", use_container_width=True):
         logout()
 
-    # Use st_autorefresh
-    if st.session_state['auto_refresh'] and not st.session_state['is_admin']:
-        refresh_interval = 60
-        st_autorefresh(interval=refresh_interval * 1000, key="datarefresh")
+    display_full_image()
 
     if st.session_state['is_admin']:
         # Admin-only features
         images = list_images_in_bucket(bucket_name, bucket_prefix)
         images += list_images_in_bucket(bucket_name, 'gallery/')
-        display_gallery(images, st.session_state['cols_per_row'], is_admin=True)
+        display_batch_actions()
+        display_gallery(paginate(images), st.session_state['cols_per_row'], is_admin=True)
     else:
+        # Read before listing, a change in between only causes one extra rerun
+        st.session_state['gallery_version'] = get_gallery_index(bucket_name).version_of('gallery/')
         images = list_images_in_bucket(bucket_name, 'gallery/')
-        display_gallery(images, st.session_state['cols_per_row'], is_admin=False)
-
-    # Clear caches if refresh is needed
-    if st.session_state['refresh_gallery']:
-        st.session_state['refresh_gallery'] = False
-        list_images_in_bucket.clear()
-        load_image_from_s3.clear()
\ No newline at end of file
+        display_gallery(paginate(images), st.session_state['cols_per_row'], is_admin=False)
+        if st.session_state['auto_refresh']:
+            # Polls the shared index instead of rerunning the whole page on a timer
+            watch_gallery('gallery/')
@@ -0,0 +1,93 @@
+"""
+Image I/O of the gallery against S3: concurrent page fetches, thumbnail renditions and moving
+avatars between prefixes.
+Nothing in here imports Streamlit, avatar_gallery.py passes in the process-wide clients and caches.
+"""
+import io
+import logging
+from concurrent.futures import as_completed
+
+from botocore.exceptions import ClientError
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# File extension and Content-Type of each rendition format. st.image only serves JPEG and PNG,
+# anything else is decoded and re-encoded as JPEG on every render, so WebP is only used for
+# renditions the browser loads itself from signed URLs.
+THUMBNAIL_FORMATS = {
+    "JPEG": ("jpeg", "image/jpeg"),
+    "WEBP": ("webp", "image/webp"),
+}
+
+# delete_objects accepts at most this many keys per call
+DELETE_BATCH_SIZE = 1000
+
+def prefetch(executor, load, keys):
+    """Runs load(key) for every key on the executor, yields (index, result) in completion order
+    so the caller can render each image as soon as it arrives. The result of a key that could
+    not be loaded is None, one missing or broken image must not take down the whole page."""
+    futures = {executor.submit(load, key): i for i, key in enumerate(keys)}
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.warning(f"Could not load gallery image {keys[futures[future]]}: {e}")
+            result = None
+        yield futures[future], result
+
+def thumbnail_key(thumbnail_prefix, key, size, format):
+    # Keyed by file name only, so promoting or moderating an avatar keeps its thumbnails
+    return f"{thumbnail_prefix}{size}/{key.split('/')[-1]}.{THUMBNAIL_FORMATS[format][0]}"
+
+def encode_thumbnails(image_content, sizes, format):
+    """Returns {size: encoded bytes} with one rendition per size that fits into size x size."""
+    renditions = {}
+    with Image.open(io.BytesIO(image_content)) as image:
+        image = image.convert('RGB')
+        for size in sizes:
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size, size), Image.LANCZOS)
+            with io.BytesIO() as buf:
+                thumbnail.save(buf, format=format, quality=80)
+                renditions[size] = buf.getvalue()
+    return renditions
+
+def move_objects(s3_client, executor, index, image_cache, moves, url_cache=None):
+    """Moves (source, destination) pairs within index.bucket with concurrent copies and one
+    delete_objects call per 1000 keys. The index and caches are updated in place and the
+    moves are recorded as one batch event, nothing is listed again.
+    Returns the pairs that were copied and the (pair, error) of the ones that were not."""
+    bucket = index.bucket
+    copies = {executor.submit(s3_client.copy_object, CopySource={'Bucket': bucket, 'Key': source_key},
+                              Bucket=bucket, Key=dest_key): (source_key, dest_key)
+              for source_key, dest_key in moves}
+    copied = {}
+    failed = []
+    for future in as_completed(copies):
+        try:
+            copied[copies[future]] = future.result()['CopyObjectResult']
+        except ClientError as e:
+            logger.error(f"Could not copy {copies[future][0]} to {copies[future][1]}: {e}")
+            failed.append((copies[future], e))
+
+    not_deleted = set()
+    sources = [source_key for source_key, _ in copied]
+    for i in range(0, len(sources), DELETE_BATCH_SIZE):
+        response = s3_client.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in sources[i:i + DELETE_BATCH_SIZE]], 'Quiet': True})
+        not_deleted.update(error['Key'] for error in response.get('Errors', []))
+
+    events = []
+    for (source_key, dest_key), result in copied.items():
+        events.append({"op": "put", "key": dest_key, "last_modified": result['LastModified'].timestamp(),
+                       "etag": result['ETag']})
+        if source_key in not_deleted:
+            continue
+        events.append({"op": "delete", "key": source_key, "last_modified": None, "etag": None})
+        image_cache.rename(source_key, dest_key, result['ETag'])
+        if url_cache:
+            url_cache.forget(source_key)
+    if events:
+        index.record(events)
+    return list(copied), failed
@@ -0,0 +1,214 @@
+"""
+Process-wide gallery state kept in sync with S3: the index of avatar keys, maintained from
+event objects, and the LRU cache of encoded image bytes. Nothing in here imports Streamlit.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+def is_image_key(key):
+    return key.endswith(('.png', '.jpg', '.jpeg'))
+
+class ImageCache:
+    """Process-wide LRU cache of encoded image bytes, bounded by their total size.
+    Entries older than revalidate_after are checked with If-None-Match instead of refetched."""
+
+    def __init__(self, s3_client, max_bytes, revalidate_after):
+        self._s3_client = s3_client
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_bytes = max_bytes
+        self._revalidate_after = revalidate_after
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    def _put(self, key, etag, data):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self._bytes -= len(old["data"])
+            if len(data) > self._max_bytes:
+                return
+            self._entries[key] = {"etag": etag, "data": data, "validated": time.time()}
+            self._bytes += len(data)
+            while self._bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted["data"])
+                self.evictions += 1
+
+    def get(self, bucket, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                if time.time() - entry["validated"] < self._revalidate_after:
+                    self.hits += 1
+                    return entry["data"]
+        if entry:
+            try:
+                response = self._s3_client.get_object(Bucket=bucket, Key=key, IfNoneMatch=entry["etag"])
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('304', 'NotModified'):
+                    raise
+                with self._lock:
+                    entry["validated"] = time.time()
+                    self.hits += 1
+                    self.revalidations += 1
+                return entry["data"]
+        else:
+            response = self._s3_client.get_object(Bucket=bucket, Key=key)
+        data = response['Body'].read()
+        with self._lock:
+            self.misses += 1
+        self._put(key, response['ETag'], data)
+        return data
+
+    def rename(self, key, new_key, etag):
+        """Keeps the bytes of a copied object under its new key."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry:
+                replaced = self._entries.pop(new_key, None)
+                if replaced:
+                    self._bytes -= len(replaced["data"])
+                entry["etag"] = etag
+                self._entries[new_key] = entry
+
+    def add(self, key, etag, data):
+        self._put(key, etag, data)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits,
+                    "misses": self.misses, "revalidations": self.revalidations, "evictions": self.evictions}
+
+class GalleryIndex:
+    """In-process index of the avatar keys in the bucket. It is built with one full listing,
+    after that only the event objects written since the last cursor are read.
+
+    Event keys are the writer's time_ns, and a slow PUT or a skewed clock can make an event
+    visible after newer ones. The listing cursor therefore trails the clock by lag seconds and
+    the events seen inside that window are remembered, so they are applied exactly once."""
+
+    def __init__(self, s3_client, bucket, prefixes, events_prefix, refresh_interval, lag=30):
+        self._s3_client = s3_client
+        self.bucket = bucket
+        self.prefixes = prefixes
+        self.events_prefix = events_prefix
+        self.refresh_interval = refresh_interval
+        self.lag = lag
+        self.version = 0
+        self._prefix_versions = dict.fromkeys(prefixes, 0)
+        self._items = {}
+        self._cursor = None
+        # Keys of the applied events after the cursor, pruned as the cursor moves on
+        self._applied = set()
+        self._last_refresh = 0
+        self._lock = threading.Lock()
+
+    def _list(self, **kwargs):
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, **kwargs):
+            yield from page.get('Contents', [])
+
+    def _lagged_cursor(self):
+        return f"{self.events_prefix}{time.time_ns() - int(self.lag * 10**9):020d}"
+
+    def _bootstrap(self):
+        # Start one lag window before the listing, replaying an event twice is harmless
+        self._cursor = self._lagged_cursor()
+        for prefix in self.prefixes:
+            for item in self._list(Prefix=prefix):
+                if is_image_key(item['Key']):
+                    self._items[item['Key']] = {
+                        "key": item['Key'],
+                        "last_modified": item['LastModified'].timestamp(),
+                        "etag": item['ETag']
+                    }
+        self.version += 1
+        for prefix in self.prefixes:
+            self._prefix_versions[prefix] += 1
+
+    def _apply(self, event):
+        if event["op"] == "batch":
+            for batch_event in event["events"]:
+                self._apply(batch_event)
+            return
+        if event["op"] == "put":
+            self._items[event["key"]] = {
+                "key": event["key"],
+                "last_modified": event.get("last_modified") or time.time(),
+                "etag": event.get("etag")
+            }
+        elif event["op"] == "delete":
+            self._items.pop(event["key"], None)
+        for prefix in self.prefixes:
+            if event["key"].startswith(prefix):
+                self._prefix_versions[prefix] += 1
+
+    def refresh(self, force=False):
+        with self._lock:
+            if self._cursor is None:
+                self._bootstrap()
+                self._last_refresh = time.time()
+                return
+            if not force and time.time() - self._last_refresh < self.refresh_interval:
+                return
+            self._last_refresh = time.time()
+            # Events older than the lag window are assumed visible by now, taken before listing
+            cursor = max(self._cursor, self._lagged_cursor())
+            changed = False
+            for item in self._list(Prefix=self.events_prefix, StartAfter=self._cursor):
+                if item['Key'] in self._applied:
+                    # Seen by an earlier refresh or written by this process
+                    continue
+                response = self._s3_client.get_object(Bucket=self.bucket, Key=item['Key'])
+                self._apply(json.loads(response['Body'].read()))
+                self._applied.add(item['Key'])
+                changed = True
+            self._cursor = cursor
+            self._applied = {key for key in self._applied if key > cursor}
+            if changed:
+                self.version += 1
+
+    def apply(self, event_key, events):
+        """Applies events this process has just written, without waiting for the next refresh."""
+        with self._lock:
+            if self._cursor is None:
+                return
+            for event in events:
+                self._apply(event)
+            self._applied.add(event_key)
+            self.version += 1
+
+    def record(self, events):
+        """Writes several put/delete events as one batch event object and applies them locally.
+        Returns the event key."""
+        # Event keys sort by time, readers list only the keys after their cursor
+        event_key = f"{self.events_prefix}{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.json"
+        self._s3_client.put_object(Bucket=self.bucket, Key=event_key,
+                                   Body=json.dumps({"op": "batch", "events": events}).encode("utf-8"),
+                                   ContentType="application/json")
+        self.apply(event_key, events)
+        return event_key
+
+    def version_of(self, prefix):
+        """Changes whenever an avatar is added to or removed from the prefix."""
+        self.refresh()
+        with self._lock:
+            return self._prefix_versions[prefix]
+
+    def images(self, prefix):
+        """Keys under the prefix, newest first."""
+        self.refresh()
+        with self._lock:
+            items = [item for key, item in self._items.items() if key.startswith(prefix)]
+        items.sort(key=lambda item: (item["last_modified"], item["key"]), reverse=True)
+        return [item["key"] for item in items]
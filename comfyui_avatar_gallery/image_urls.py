@@ -0,0 +1,74 @@
+"""
+Short-lived URLs for gallery images, so browsers fetch them directly from S3 or CloudFront
+instead of through the Streamlit server. Nothing in here talks to AWS, signing is purely local.
+"""
+import threading
+import time
+import datetime
+import urllib.parse
+
+from botocore.signers import CloudFrontSigner
+
+def rsa_signer(private_key_pem):
+    """Returns a callable that signs a CloudFront policy with the given RSA private key (PEM)."""
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    if isinstance(private_key_pem, str):
+        private_key_pem = private_key_pem.encode()
+    private_key = serialization.load_pem_private_key(private_key_pem, password=None)
+
+    def sign(message):
+        return private_key.sign(message, padding.PKCS1v15(), hashes.SHA1())
+    return sign
+
+def cloudfront_url_signer(domain, key_id, private_key_pem):
+    """Signs https://<domain>/<key> with a canned policy for a CloudFront trusted key group."""
+    signer = CloudFrontSigner(key_id, rsa_signer(private_key_pem))
+
+    def sign(key, expires_at):
+        url = f"https://{domain}/{urllib.parse.quote(key)}"
+        return signer.generate_presigned_url(
+            url, date_less_than=datetime.datetime.fromtimestamp(expires_at, tz=datetime.timezone.utc))
+    return sign
+
+def s3_url_signer(s3_client, bucket):
+    """Signs GetObject requests for the bucket, s3_client only needs credentials and a region."""
+    def sign(key, expires_at):
+        return s3_client.generate_presigned_url(
+            'get_object', Params={'Bucket': bucket, 'Key': key},
+            ExpiresIn=max(1, int(expires_at - time.time())))
+    return sign
+
+def url_signer(s3_client, bucket, cloudfront_domain=None, key_id=None, private_key_pem=None):
+    """CloudFront signed URLs when a key pair is configured, presigned S3 URLs otherwise."""
+    if private_key_pem:
+        return cloudfront_url_signer(cloudfront_domain, key_id, private_key_pem)
+    return s3_url_signer(s3_client, bucket)
+
+class SignedUrlCache:
+    """Hands out signed URLs and reuses them for half their lifetime. A stable URL lets the
+    browser and the CDN cache the image across reruns instead of fetching it again."""
+
+    def __init__(self, sign, ttl, clock=time.time):
+        self._sign = sign
+        self._ttl = ttl
+        self._clock = clock
+        self._urls = {}
+        self._lock = threading.Lock()
+
+    def url(self, key):
+        now = self._clock()
+        with self._lock:
+            cached = self._urls.get(key)
+            if cached and cached[1] - now > self._ttl / 2:
+                return cached[0]
+        expires_at = now + self._ttl
+        url = self._sign(key, expires_at)
+        with self._lock:
+            self._urls[key] = (url, expires_at)
+        return url
+
+    def forget(self, key):
+        with self._lock:
+            self._urls.pop(key, None)
@@ -75,6 +75,14 @@ record_name_comfyui = os.environ.get('RECORD_NAME_COMFYUI')
 record_name_avatar_app = os.environ.get('RECORD_NAME_AVATAR_APP')
 record_name_avatar_gallery = os.environ.get('RECORD_NAME_AVATAR_GALLERY')
 model_bucket_name = os.environ.get("MODEL_BUCKET_NAME")
+# optional: PEM public key of a CloudFront key pair, the gallery then serves images through signed CloudFront URLs.
+# The matching private key is expected in the Secrets Manager secret "GalleryCloudFrontPrivateKey".
+gallery_cloudfront_public_key = os.environ.get("GALLERY_CLOUDFRONT_PUBLIC_KEY")
+# where the GPU nodes keep the models: "nvme" (instance store, EFS as fallback) or "efs"
+model_placement = os.environ.get("MODEL_PLACEMENT", "efs")
+# optional: number of recent prompts whose node outputs ComfyUI keeps (--cache-lru), "0" (default) is off.
+# Any other value also turns on the avatar app's reuse of face analysis for repeat generations.
+comfyui_cache_lru = os.environ.get("COMFYUI_CACHE_LRU", "0")
 
 class ComfyUIStack(Stack):
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
@@ -263,10 +271,25 @@ class ComfyUIStack(Stack):
         # Create necessary directories 
         mkdir -p $NVME_MOUNT/comfyui/models
 
+        # Models are read from the local instance store if there is one, extra_model_paths_nvme.yaml
+        # lists it before the EFS models directory
+        MODEL_PLACEMENT='{model_placement}'
+        MODEL_DIR=$EFS_MOUNT/models
+        if [ "$MODEL_PLACEMENT" = "nvme" ] && mountpoint -q $NVME_MOUNT; then
+            MODEL_DIR=$NVME_MOUNT/comfyui/models
+        fi
+
         # Check if the model bucket name is provided
         if [ -n "{model_bucket.bucket_name}" ]; then
-            echo "Syncing models from S3 bucket: {model_bucket.bucket_name}"
-            aws s3 sync s3://{model_bucket.bucket_name}/models $EFS_MOUNT/models --no-progress
+            echo "Syncing models from S3 bucket: {model_bucket.bucket_name} to $MODEL_DIR"
+            aws configure set default.s3.max_concurrent_requests 64
+            aws configure set default.s3.multipart_chunksize 64MB
+            aws s3 sync s3://{model_bucket.bucket_name}/models $MODEL_DIR --no-progress
+            if [ "$MODEL_DIR" != "$EFS_MOUNT/models" ]; then
+                # Some custom nodes read these from the ComfyUI models directory only, they are small
+                aws s3 sync s3://{model_bucket.bucket_name}/models $EFS_MOUNT/models --no-progress --exclude "*" \\
+                    --include "insightface/*" --include "facerestore_models/*"
+            fi
         else
             echo "No model bucket specified, skipping S3 sync."
         fi
@@ -467,7 +490,9 @@ class ComfyUIStack(Stack):
             cpu=15500,
             logging=ecs.LogDriver.aws_logs(stream_prefix="comfy-ui", log_group=log_group),
             environment={
-                "MODEL_PATH": "/mnt/nvme/comfyui/models",  # TODO: check nvme path mount in comfyui yaml
+                "MODEL_PATH": "/mnt/nvme/comfyui/models",  # listed first in extra_model_paths_nvme.yaml
+                "MODEL_PLACEMENT": model_placement,
+                "COMFYUI_CACHE_LRU": comfyui_cache_lru,
                 "EFS_MOUNT_PATH": "/home/user/opt/ComfyUI",
             },
             health_check=ecs.HealthCheck(
@@ -919,7 +944,9 @@ class ComfyUIStack(Stack):
                 cpu=4000,
                 logging=ecs.LogDriver.aws_logs(stream_prefix="comfy-ui", log_group=log_group),
                 environment={
-                    "MODEL_PATH": "/mnt/nvme/comfyui/models",  # TODO: check nvme path mount in comfyui yaml
+                    "MODEL_PATH": "/mnt/nvme/comfyui/models",  # listed first in extra_model_paths_nvme.yaml
+                    "MODEL_PLACEMENT": model_placement,
+                    "COMFYUI_CACHE_LRU": comfyui_cache_lru,
                     "EFS_MOUNT_PATH": "/home/user/opt/ComfyUI",
                 },
                 health_check=ecs.HealthCheck(
@@ -1152,15 +1179,6 @@ class ComfyUIStack(Stack):
             )
 
 
-            avatar_cloudfront_distribution.add_behavior(
-                path_pattern="/*",
-                origin=origins.LoadBalancerV2Origin(avatar_alb),
-                viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
-                allowed_methods=cloudfront.AllowedMethods.ALLOW_ALL,
-                cache_policy=cloudfront.CachePolicy.CACHING_DISABLED, 
-                origin_request_policy=cloudfront.OriginRequestPolicy.ALL_VIEWER
-            )
-
 
             alb_log_role = iam.Role(self, "ALBLogRole",
                 assumed_by=iam.ServicePrincipal("elasticloadbalancing.amazonaws.com"),
@@ -1215,13 +1233,52 @@ class ComfyUIStack(Stack):
                 auto_delete_objects=True,
                 enforce_ssl=True,
                 server_access_logs_bucket=avatar_log_bucket,
-                server_access_logs_prefix="avatar-bucket-log/"
+                server_access_logs_prefix="avatar-bucket-log/",
+                lifecycle_rules=[
+                    # Gallery index events are only needed until every gallery task has read them
+                    s3.LifecycleRule(
+                        prefix="gallery-index/events/",
+                        expiration=Duration.days(7)
+                    )
+                ]
             )
 
             trail.add_s3_event_selector([cloudtrail.S3EventSelector(
                 bucket=avatar_bucket
             )])
 
+            # Gallery images are fetched by the browsers straight from the edge with signed URLs
+            gallery_image_key_group = None
+            if deployment_type in ["FullStack"] and gallery_cloudfront_public_key:
+                gallery_image_public_key = cloudfront.PublicKey(
+                    self, "GalleryImagePublicKey",
+                    encoded_key=gallery_cloudfront_public_key
+                )
+                gallery_image_key_group = cloudfront.KeyGroup(
+                    self, "GalleryImageKeyGroup",
+                    items=[gallery_image_public_key]
+                )
+                avatar_bucket_origin = origins.S3Origin(avatar_bucket)
+                for path_pattern in ["/gallery/*", "/avatars/*", "/thumbnails/*"]:
+                    avatar_cloudfront_distribution.add_behavior(
+                        path_pattern=path_pattern,
+                        origin=avatar_bucket_origin,
+                        viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+                        allowed_methods=cloudfront.AllowedMethods.ALLOW_GET_HEAD,
+                        cache_policy=cloudfront.CachePolicy.CACHING_OPTIMIZED,
+                        trusted_key_groups=[gallery_image_key_group]
+                    )
+
+            # Added after the bucket behaviors, CloudFront matches behaviors in order
+            avatar_cloudfront_distribution.add_behavior(
+                path_pattern="/*",
+                origin=origins.LoadBalancerV2Origin(avatar_alb),
+                viewer_protocol_policy=cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+                allowed_methods=cloudfront.AllowedMethods.ALLOW_ALL,
+                cache_policy=cloudfront.CachePolicy.CACHING_DISABLED, 
+                origin_request_policy=cloudfront.OriginRequestPolicy.ALL_VIEWER
+            )
+
             # ECR Repository
             ecr_repository_avatar_app = ecr.Repository.from_repository_name(
                 self, 
@@ -1270,6 +1327,13 @@ class ComfyUIStack(Stack):
                 resources=[f"arn:aws:bedrock:{self.region}::foundation-model/*"] 
             ))
 
+            # ComfyUI backend discovery, ELB describe calls do not support resource-level permissions
+            avatar_task_exec_role.add_to_policy(iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=["elasticloadbalancing:DescribeTargetHealth"],
+                resources=["*"]
+            ))
+
 
             ec2_role.add_to_policy(iam.PolicyStatement(
                 effect=iam.Effect.ALLOW,
@@ -1386,6 +1450,13 @@ class ComfyUIStack(Stack):
                 ),
                 environment={
                     "COMFYUI": comfyui_alb_internal.load_balancer_dns_name,
+                    # Route prompts directly to the ComfyUI tasks registered behind the internal ALB
+                    "COMFYUI_DISCOVERY": "target-group",
+                    "COMFYUI_TARGET_GROUP_ARN": ecs_comfyui_api_target_group.target_group_arn,
+                    # Reusing face analysis needs the node outputs kept by ComfyUI's LRU cache
+                    "FACE_CACHE": "false" if comfyui_cache_lru == "0" else "true",
+                    # Same rendition format the gallery reads: WebP behind signed URLs, JPEG through Streamlit
+                    "THUMBNAIL_FORMAT": "WEBP" if gallery_cloudfront_public_key else "JPEG",
                     "S3_BUCKET": avatar_bucket.bucket_name,
                     "S3_BUCKET_PREFIX": "avatars/"
                 },
@@ -1484,6 +1555,26 @@ class ComfyUIStack(Stack):
                     execution_role=avatar_task_exec_role,
                 )
 
+                avatar_gallery_environment = {
+                    "S3_BUCKET": avatar_bucket.bucket_name,
+                    "S3_BUCKET_PREFIX": "avatars/"
+                }
+                avatar_gallery_secrets = {
+                    "COGNITO_POOL_ID": ecs.Secret.from_secrets_manager(cognito_secrets, "COGNITO_POOL_ID"),
+                    "COGNITO_APP_CLIENT_ID": ecs.Secret.from_secrets_manager(cognito_secrets, "COGNITO_APP_CLIENT_ID"),
+                    "COGNITO_APP_CLIENT_SECRET": ecs.Secret.from_secrets_manager(cognito_secrets, "COGNITO_APP_CLIENT_SECRET")
+                }
+                if gallery_image_key_group:
+                    gallery_private_key_secret = secretsmanager.Secret.from_secret_name_v2(
+                        self, "GalleryCloudFrontPrivateKey", "GalleryCloudFrontPrivateKey")
+                    avatar_gallery_environment.update({
+                        "GALLERY_IMAGE_MODE": "cloudfront",
+                        "GALLERY_CLOUDFRONT_DOMAIN": record_name_avatar_gallery,
+                        "GALLERY_CLOUDFRONT_KEY_ID": gallery_image_public_key.public_key_id
+                    })
+                    avatar_gallery_secrets["GALLERY_CLOUDFRONT_PRIVATE_KEY"] = \
+                        ecs.Secret.from_secrets_manager(gallery_private_key_secret)
+
                 avatar_gallery_container = avatar_gallery_task_definition.add_container(
                     "AvatarGalleryContainer",
                     container_name="AvatarGalleryContainer",
@@ -1496,15 +1587,8 @@ class ComfyUIStack(Stack):
                         retries=8,
                         start_period=Duration.seconds(30)
                     ),
-                    environment={
-                        "S3_BUCKET": avatar_bucket.bucket_name,
-                        "S3_BUCKET_PREFIX": "avatars/"
-                    },
-                    secrets={
-                        "COGNITO_POOL_ID": ecs.Secret.from_secrets_manager(cognito_secrets, "COGNITO_POOL_ID"),
-                        "COGNITO_APP_CLIENT_ID": ecs.Secret.from_secrets_manager(cognito_secrets, "COGNITO_APP_CLIENT_ID"),
-                        "COGNITO_APP_CLIENT_SECRET": ecs.Secret.from_secrets_manager(cognito_secrets, "COGNITO_APP_CLIENT_SECRET")
-                    }
+                    environment=avatar_gallery_environment,
+                    secrets=avatar_gallery_secrets
                 )
 
                 avatar_gallery_container.add_port_mappings(
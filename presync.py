@@ -6,6 +6,13 @@ import hashlib
 import boto3
 import requests
 import shutil
+import json
+import time
+import argparse
+import threading
+from boto3.s3.transfer import TransferConfig
+from s3transfer.utils import ChunksizeAdjuster
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -13,6 +20,16 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 # Global Variables
 LOCAL_MODEL_DIR = "./models"
 DOWNLOAD_LIST_FILE = "model_list.txt"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Files at least this large are fetched as parallel byte ranges if the server supports it
+PARALLEL_DOWNLOAD_MIN_SIZE = 512 * 1024 * 1024
+PARALLEL_DOWNLOAD_PART_SIZE = 128 * 1024 * 1024
+PARALLEL_DOWNLOAD_WORKERS = 4
+DOWNLOAD_TIMEOUT = (10, 60)
+# Files uploaded at the same time, and the parts uploaded at the same time per file
+UPLOAD_WORKERS = 4
+UPLOAD_PART_CONCURRENCY = 8
+UPLOAD_PART_SIZE = 64 * 1024 * 1024
 
 def get_unique_suffix():
     session = boto3.Session()
@@ -60,28 +77,174 @@ def ensure_bucket_exists(s3_client, bucket_name, region):
             print(f"Unexpected error (HTTP {error_code}): {e}")
             sys.exit(1)
 
-def download_file(url, output_path):
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    if not os.path.exists(output_path):
-        print(f"Downloading {output_path}")
-        response = requests.get(url, stream=True)
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def probe_download(url):
+    """Returns the URL after redirects, the size and whether byte ranges are supported."""
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT)
         response.raise_for_status()
-        total_size = int(response.headers.get('content-length', 0))
-        with open(output_path, 'wb') as f, tqdm(
-            desc=output_path,
-            total=total_size,
-            unit='iB',
-            unit_scale=True,
-            unit_divisor=1024,
-        ) as bar:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    size = f.write(chunk)
-                    bar.update(size)
+    except requests.RequestException:
+        return url, None, False
+    size = response.headers.get('content-length')
+    accepts_ranges = response.headers.get('accept-ranges', '').lower() == 'bytes'
+    return response.url, int(size) if size else None, accepts_ranges
+
+def download_sequential(url, part_path, bar):
+    """Streams into part_path, resuming after the bytes already in it. Returns the sha256."""
+    sha256 = hashlib.sha256()
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    response = requests.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    if offset and response.status_code == 416:
+        response.close()
+        # Content-Range: bytes */<size> tells whether the part file is already complete
+        if response.headers.get('Content-Range', '').rpartition('/')[2] == str(offset):
+            # The earlier run got every byte but died before the rename
+            print(f"{part_path} is already complete")
+            bar.update(offset)
+            return file_sha256(part_path)
+        print(f"{part_path} does not match the remote file, restarting it")
+        offset = 0
+        response = requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    if offset and response.status_code != 206:
+        print(f"Server ignored the range request, restarting {part_path}")
+        offset = 0
+    if offset:
+        # The bytes from the earlier run are part of the checksum
+        with open(part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        bar.update(offset)
+    with open(part_path, 'ab' if offset else 'wb') as f:
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            if chunk:
+                sha256.update(chunk)
+                bar.update(f.write(chunk))
+    return sha256.hexdigest()
+
+def download_ranges(url, part_path, size, bar):
+    """Fetches the file as parallel byte ranges. Finished ranges are recorded next to the
+    part file, an interrupted download only fetches the missing ones again."""
+    ranges_path = f"{part_path}.ranges"
+    done = set()
+    if os.path.exists(part_path) and os.path.exists(ranges_path):
+        with open(ranges_path) as f:
+            done = set(json.load(f))
     else:
-        print(f"File {output_path} already exists. Skipping download.")
+        with open(part_path, 'wb') as f:
+            f.truncate(size)
+        # Marks the part file as a ranged download right away
+        with open(ranges_path, 'w') as f:
+            json.dump([], f)
+    starts = range(0, size, PARALLEL_DOWNLOAD_PART_SIZE)
+    bar.update(sum(min(PARALLEL_DOWNLOAD_PART_SIZE, size - start) for start in done))
+
+    def fetch(start):
+        end = min(start + PARALLEL_DOWNLOAD_PART_SIZE, size) - 1
+        response = requests.get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True,
+                                timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError(f"Server did not return a byte range for {url}")
+        written = 0
+        with open(part_path, 'r+b') as f:
+            f.seek(start)
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if chunk:
+                    written += f.write(chunk)
+                    bar.update(len(chunk))
+        # A connection closed early without Content-Length looks like a complete response
+        if written != end - start + 1:
+            raise IOError(f"Range {start}-{end} of {url} ended after {written} bytes")
+        return start
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=PARALLEL_DOWNLOAD_WORKERS) as executor:
+        futures = [executor.submit(fetch, start) for start in starts if start not in done]
+        for future in as_completed(futures):
+            try:
+                done.add(future.result())
+            except OSError as e:
+                errors.append(e)
+                continue
+            with open(ranges_path, 'w') as f:
+                json.dump(sorted(done), f)
+    if errors:
+        # The other ranges are recorded, the next run only fetches the failed ones
+        raise errors[0]
+
+def download_file(url, output_path, size=None, sha256=None):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    part_path = f"{output_path}.part"
+    ranges_path = f"{part_path}.ranges"
+    probe = None
+    if os.path.exists(output_path):
+        existing_size = os.path.getsize(output_path)
+        expected_size = size
+        if expected_size is None:
+            # No size in the manifest, compare with the Content-Length of the server
+            probe = probe_download(url)
+            expected_size = probe[1]
+        if expected_size is not None and existing_size != expected_size:
+            print(f"File {output_path} has {existing_size} bytes instead of {expected_size}, downloading it again.")
+            if existing_size < expected_size and not os.path.exists(part_path):
+                # Most likely cut off by an earlier version of this script, resume from there
+                os.replace(output_path, part_path)
+            else:
+                os.remove(output_path)
+        elif sha256 is None:
+            print(f"File {output_path} already exists. Skipping download.")
+            return
+        elif file_sha256(output_path) == sha256:
+            print(f"File {output_path} already exists and matches its checksum. Skipping download.")
+            return
+        else:
+            print(f"File {output_path} does not match its checksum, downloading it again.")
+            os.remove(output_path)
+
+    download_url, remote_size, accepts_ranges = probe or probe_download(url)
+    if size and remote_size and size != remote_size:
+        raise IOError(f"{url} has {remote_size} bytes, the manifest expects {size}")
+    size = size or remote_size
+    # A part file without a ranges file came from a sequential download and is resumed as such
+    resume_sequential = os.path.exists(part_path) and not os.path.exists(ranges_path)
+    print(f"Downloading {output_path}")
+    with tqdm(
+        desc=output_path,
+        total=size,
+        unit='iB',
+        unit_scale=True,
+        unit_divisor=1024,
+    ) as bar:
+        if accepts_ranges and size and size >= PARALLEL_DOWNLOAD_MIN_SIZE and not resume_sequential:
+            download_ranges(download_url, part_path, size, bar)
+            digest = None
+        else:
+            digest = download_sequential(download_url, part_path, bar)
+
+    downloaded_size = os.path.getsize(part_path)
+    if size and downloaded_size != size:
+        # Kept, the next run resumes it
+        raise IOError(f"Download of {output_path} incomplete: {downloaded_size} of {size} bytes")
+    if sha256:
+        # Ranges arrive out of order, their checksum is computed once the file is complete
+        digest = digest or file_sha256(part_path)
+        if digest != sha256:
+            os.remove(part_path)
+            raise IOError(f"Checksum mismatch for {output_path}: expected {sha256}, got {digest}")
+    os.replace(part_path, output_path)
+    if os.path.exists(ranges_path):
+        os.remove(ranges_path)
 
 def read_download_list(file_path):
+    """Reads lines of the form: <url> <path> [size=<bytes>] [sha256=<hex digest>]"""
     if not os.path.isfile(file_path):
         print(f"Error: {file_path} file not found!")
         sys.exit(1)
@@ -90,61 +253,294 @@ def read_download_list(file_path):
         for line in f:
             line = line.strip()
             if line and not line.startswith('#'):
-                parts = line.split(' ', 1)
-                if len(parts) == 2:
-                    url, output_path = parts
-                    download_list.append((url.strip(), output_path.strip()))
-                else:
+                parts = line.split()
+                if len(parts) < 2:
                     print(f"Invalid line in {file_path}: {line}")
+                    continue
+                url, output_path = parts[:2]
+                fields = dict(part.partition('=')[::2] for part in parts[2:])
+                try:
+                    size = int(fields['size']) if 'size' in fields else None
+                except ValueError:
+                    print(f"Invalid size in {file_path}: {line}")
+                    continue
+                sha256 = fields.get('sha256', '').lower() or None
+                download_list.append((url, output_path, size, sha256))
     return download_list
 
-def upload_file_to_s3_if_not_exists(s3_client, file_path, bucket_name, s3_key):
-    try:
-        # Check if the object already exists
-        s3_client.head_object(Bucket=bucket_name, Key=s3_key)
-        print(f"File s3://{bucket_name}/{s3_key} already exists. Skipping upload.")
-    except ClientError as e:
-        if e.response['Error']['Code'] == '404':
-            # Object does not exist, proceed to upload
-            try:
-                s3_client.upload_file(file_path, bucket_name, s3_key)
-                print(f"Uploaded {file_path} to s3://{bucket_name}/{s3_key}")
-            except ClientError as upload_error:
-                print(f"Failed to upload {file_path} to s3://{bucket_name}/{s3_key}")
-                print(upload_error)
-                sys.exit(1)
-        else:
-            print(f"Error checking existence of s3://{bucket_name}/{s3_key}")
-            print(e)
-            sys.exit(1)
+def get_transfer_config(part_size=UPLOAD_PART_SIZE, part_concurrency=UPLOAD_PART_CONCURRENCY):
+    return TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size,
+                          max_concurrency=part_concurrency, use_threads=True)
+
+def list_s3_objects(s3_client, bucket_name, s3_prefix=''):
+    """Size and ETag of every object under the prefix, read with one listing pass."""
+    objects = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=s3_prefix):
+        for item in page.get('Contents', []):
+            objects[item['Key']] = {"size": item['Size'], "etag": item['ETag'].strip('"')}
+    return objects
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def local_etag(file_path, part_size):
+    """The ETag S3 assigns to the file when it is uploaded with the given part size."""
+    file_size = os.path.getsize(file_path)
+    if file_size < part_size:
+        # Below the multipart threshold, a single PUT
+        return file_md5(file_path)
+    # upload_file raises too small or too many parts to what S3 accepts, the same here
+    part_size = ChunksizeAdjuster().adjust_chunksize(part_size, file_size)
+    part_md5s = []
+    with open(file_path, 'rb') as f:
+        for part in iter(lambda: f.read(part_size), b''):
+            part_md5s.append(hashlib.md5(part).digest())
+    return f"{hashlib.md5(b''.join(part_md5s)).hexdigest()}-{len(part_md5s)}"
+
+def is_in_sync(s3_client, bucket_name, s3_key, local_path, remote, sha256, verify, part_size):
+    if remote is None or remote["size"] != os.path.getsize(local_path):
+        return False
+    if not verify:
+        return True
+    if sha256:
+        # Stored at upload time, saves reading the local file
+        response = s3_client.head_object(Bucket=bucket_name, Key=s3_key)
+        if response.get('Metadata', {}).get('sha256') == sha256:
+            return True
+    return local_etag(local_path, part_size) == remote["etag"]
 
-def sync_directory_to_s3(s3_client, local_dir, bucket_name, s3_prefix=''):
+def sync_directory_to_s3(s3_client, local_dir, bucket_name, s3_prefix='', checksums=None, verify=False,
+                         workers=UPLOAD_WORKERS, transfer_config=None):
+    """Uploads every file that is missing in the bucket or differs in size (and, with verify,
+    in checksum), several files at a time. checksums maps relative paths to known sha256 digests,
+    they are stored as object metadata."""
+    checksums = checksums or {}
+    transfer_config = transfer_config or get_transfer_config()
+    remote_objects = list_s3_objects(s3_client, bucket_name, s3_prefix)
+
+    uploads = []
     for root, dirs, files in os.walk(local_dir):
         for file in files:
+            if file.endswith(('.part', '.ranges')):
+                # Left behind by an interrupted download
+                continue
             local_path = os.path.join(root, file)
-            relative_path = os.path.relpath(local_path, local_dir)
+            relative_path = os.path.relpath(local_path, local_dir).replace("\\", "/")
             s3_key = os.path.join(s3_prefix, relative_path).replace("\\", "/")
-            upload_file_to_s3_if_not_exists(s3_client, local_path, bucket_name, s3_key)
+            uploads.append((local_path, s3_key, checksums.get(relative_path)))
+
+    def sync_file(local_path, s3_key, sha256, bar):
+        if is_in_sync(s3_client, bucket_name, s3_key, local_path, remote_objects.get(s3_key), sha256,
+                      verify, transfer_config.multipart_chunksize):
+            bar.update(os.path.getsize(local_path))
+            return None
+        extra_args = {'Metadata': {'sha256': sha256}} if sha256 else None
+        s3_client.upload_file(local_path, bucket_name, s3_key, ExtraArgs=extra_args,
+                              Config=transfer_config, Callback=bar.update)
+        return os.path.getsize(local_path)
+
+    start_time = time.time()
+    uploaded_files = uploaded_bytes = 0
+    total_size = sum(os.path.getsize(local_path) for local_path, _, _ in uploads)
+    with tqdm(desc="Sync", total=total_size, unit='iB', unit_scale=True, unit_divisor=1024) as bar, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(sync_file, local_path, s3_key, sha256, bar): (local_path, s3_key)
+                   for local_path, s3_key, sha256 in uploads}
+        for future in as_completed(futures):
+            local_path, s3_key = futures[future]
+            try:
+                size = future.result()
+            except (ClientError, IOError) as e:
+                print(f"Failed to upload {local_path} to s3://{bucket_name}/{s3_key}")
+                print(e)
+                sys.exit(1)
+            if size is not None:
+                uploaded_files += 1
+                uploaded_bytes += size
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f"Uploaded {uploaded_files} of {len(uploads)} files, {uploaded_bytes / 2**20:.1f} MiB "
+          f"in {elapsed:.1f}s ({uploaded_bytes / 2**20 / elapsed:.1f} MiB/s), "
+          f"{len(uploads) - uploaded_files} already in sync")
+
+def stream_file_to_s3(s3_client, url, bucket_name, s3_key, size, sha256, part_size, part_executor, part_slots,
+                      local_path=None):
+    """Streams the download straight into an S3 multipart upload. Parts are uploaded on
+    part_executor while the download continues, part_slots bounds the parts held in memory.
+    With local_path the file is also written to disk. Returns the number of bytes."""
+    download_url, remote_size, _ = probe_download(url)
+    if size and remote_size and size != remote_size:
+        raise IOError(f"{url} has {remote_size} bytes, the manifest expects {size}")
+    size = size or remote_size
+    response = requests.get(download_url, stream=True, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+
+    extra_args = {'Metadata': {'sha256': sha256}} if sha256 else {}
+    digest = hashlib.sha256()
+    buffer = bytearray()
+    upload_id = None
+    futures = []
+    received = 0
+
+    def upload_part(data, part_number):
+        try:
+            part = s3_client.upload_part(Bucket=bucket_name, Key=s3_key, UploadId=upload_id,
+                                         PartNumber=part_number, Body=data)
+            return {'PartNumber': part_number, 'ETag': part['ETag']}
+        finally:
+            part_slots.release()
+
+    def submit_part(data):
+        # Blocks the download while too many parts are waiting for their upload
+        part_slots.acquire()
+        futures.append(part_executor.submit(upload_part, data, len(futures) + 1))
+
+    local_file = open(f"{local_path}.part", 'wb') if local_path else None
+    try:
+        with tqdm(desc=s3_key, total=size, unit='iB', unit_scale=True, unit_divisor=1024) as bar:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if not chunk:
+                    continue
+                digest.update(chunk)
+                received += len(chunk)
+                if local_file:
+                    local_file.write(chunk)
+                buffer += chunk
+                while len(buffer) >= part_size:
+                    if upload_id is None:
+                        upload_id = s3_client.create_multipart_upload(
+                            Bucket=bucket_name, Key=s3_key, **extra_args)['UploadId']
+                    submit_part(bytes(buffer[:part_size]))
+                    del buffer[:part_size]
+                bar.update(len(chunk))
+
+        if size and received != size:
+            raise IOError(f"Download of {s3_key} incomplete: {received} of {size} bytes")
+        if sha256 and digest.hexdigest() != sha256:
+            raise IOError(f"Checksum mismatch for {s3_key}: expected {sha256}, got {digest.hexdigest()}")
+
+        if upload_id is None:
+            # Smaller than one part
+            s3_client.put_object(Bucket=bucket_name, Key=s3_key, Body=bytes(buffer), **extra_args)
+        else:
+            if buffer:
+                submit_part(bytes(buffer))
+            parts = [future.result() for future in futures]
+            s3_client.complete_multipart_upload(Bucket=bucket_name, Key=s3_key, UploadId=upload_id,
+                                                MultipartUpload={'Parts': parts})
+    except Exception:
+        if upload_id is not None:
+            for future in futures:
+                if future.cancel():
+                    part_slots.release()
+            s3_client.abort_multipart_upload(Bucket=bucket_name, Key=s3_key, UploadId=upload_id)
+        raise
+    finally:
+        if local_file:
+            local_file.close()
+    if local_path:
+        os.replace(f"{local_path}.part", local_path)
+    return received
+
+def stream_models_to_s3(s3_client, download_list, bucket_name, keep_local=False, verify=False,
+                        workers=UPLOAD_WORKERS, part_size=UPLOAD_PART_SIZE, part_concurrency=UPLOAD_PART_CONCURRENCY):
+    """Downloads the models straight into the bucket without a full local copy. Several files
+    are streamed at once, so the parts of one file upload while the next is downloading.
+    At most (workers + part_concurrency) parts are buffered in memory."""
+    remote_objects = list_s3_objects(s3_client, bucket_name)
+    part_slots = threading.BoundedSemaphore(part_concurrency)
+
+    def stream_model(url, output_path, size, sha256):
+        remote = remote_objects.get(output_path)
+        if remote is not None:
+            expected_size = size or probe_download(url)[1]
+            in_sync = expected_size is None or remote["size"] == expected_size
+            if in_sync and verify and sha256:
+                metadata = s3_client.head_object(Bucket=bucket_name, Key=output_path).get('Metadata', {})
+                in_sync = metadata.get('sha256') == sha256
+            if in_sync:
+                print(f"File s3://{bucket_name}/{output_path} already exists. Skipping.")
+                return None
+        local_path = None
+        if keep_local:
+            local_path = os.path.join(LOCAL_MODEL_DIR, output_path)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        return stream_file_to_s3(s3_client, url, bucket_name, output_path, size, sha256, part_size,
+                                 part_executor, part_slots, local_path)
+
+    start_time = time.time()
+    streamed_files = streamed_bytes = 0
+    with ThreadPoolExecutor(max_workers=part_concurrency) as part_executor, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(stream_model, *entry): entry[1] for entry in download_list}
+        for future in as_completed(futures):
+            try:
+                size = future.result()
+            except Exception as e:
+                print(f"Error while streaming {futures[future]}: {e}")
+                sys.exit(1)
+            if size is not None:
+                streamed_files += 1
+                streamed_bytes += size
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    print(f"Streamed {streamed_files} of {len(download_list)} files, {streamed_bytes / 2**20:.1f} MiB "
+          f"in {elapsed:.1f}s ({streamed_bytes / 2**20 / elapsed:.1f} MiB/s), "
+          f"{len(download_list) - streamed_files} already in sync")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Downloads the models and syncs them to the model bucket.")
+    parser.add_argument("--model-list", default=DOWNLOAD_LIST_FILE,
+                        help=f"Model list to download (default: {DOWNLOAD_LIST_FILE})")
+    parser.add_argument("--upload-workers", type=int, default=UPLOAD_WORKERS,
+                        help="Files uploaded in parallel")
+    parser.add_argument("--part-concurrency", type=int, default=UPLOAD_PART_CONCURRENCY,
+                        help="Multipart parts uploaded in parallel per file")
+    parser.add_argument("--part-size-mb", type=int, default=UPLOAD_PART_SIZE // 2**20,
+                        help="Multipart part size in MiB")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream each model straight into S3 instead of downloading all models first")
+    parser.add_argument("--keep-local", action="store_true",
+                        help=f"With --stream, also keep a copy of the models in {LOCAL_MODEL_DIR}")
+    parser.add_argument("--verify", action="store_true",
+                        help="Compare checksums, not only sizes, before skipping a file that is already in S3")
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
     suffix, region = get_unique_suffix()
     s3_bucket_name = f"comfyui-models-{suffix}"
 
-    s3_client = boto3.client('s3', region_name=region)
+    # Every upload worker uses up to part_concurrency connections
+    s3_client = boto3.client('s3', region_name=region, config=Config(
+        max_pool_connections=args.upload_workers * args.part_concurrency))
     ensure_bucket_exists(s3_client, s3_bucket_name, region)
 
-    os.makedirs(LOCAL_MODEL_DIR, exist_ok=True)
+    download_list = read_download_list(args.model_list)
+
+    if args.stream:
+        print(f"### Streaming models to S3 bucket: s3://{s3_bucket_name}/")
+        stream_models_to_s3(s3_client, download_list, s3_bucket_name, keep_local=args.keep_local,
+                            verify=args.verify, workers=args.upload_workers,
+                            part_size=args.part_size_mb * 2**20, part_concurrency=args.part_concurrency)
+        print(f"### Models have been uploaded to S3 bucket: s3://{s3_bucket_name}/")
+        return
 
-    download_list = read_download_list(DOWNLOAD_LIST_FILE)
+    os.makedirs(LOCAL_MODEL_DIR, exist_ok=True)
 
     # Parallel download
     print("### Downloading models in parallel...")
     max_workers = min(8, os.cpu_count() or 1)
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         futures = []
-        for url, output_path in download_list:
+        for url, output_path, size, sha256 in download_list:
             full_output_path = os.path.join(LOCAL_MODEL_DIR, output_path)
-            futures.append(executor.submit(download_file, url, full_output_path))
+            futures.append(executor.submit(download_file, url, full_output_path, size, sha256))
         for future in as_completed(futures):
             try:
                 future.result()
@@ -153,7 +549,10 @@ def main():
                 sys.exit(1)
 
     print(f"### Uploading models to S3 bucket: s3://{s3_bucket_name}/")
-    sync_directory_to_s3(s3_client, LOCAL_MODEL_DIR, s3_bucket_name)
+    checksums = {output_path: sha256 for _, output_path, _, sha256 in download_list if sha256}
+    sync_directory_to_s3(s3_client, LOCAL_MODEL_DIR, s3_bucket_name, checksums=checksums, verify=args.verify,
+                         workers=args.upload_workers,
+                         transfer_config=get_transfer_config(args.part_size_mb * 2**20, args.part_concurrency))
 
     # Uncomment the next two lines if you want to delete local models after upload
     # print("### Cleaning up local models...")
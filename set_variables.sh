@@ -11,4 +11,15 @@ export RECORD_NAME_AVATAR_APP=<your-subdomain2> # e.g. "avatar-app.${ZONE_NAME}"
 export RECORD_NAME_AVATAR_GALLERY=<your-subdomain2> # e.g. "avatar-gallery.${ZONE_NAME}"
 
 # following variable is the S3 bucket which is having all models pre-synced to be used during startup
-export MODEL_BUCKET_NAME=<comfyui-models-youruniqueid>
\ No newline at end of file
+export MODEL_BUCKET_NAME=<comfyui-models-youruniqueid>
+
+# optional: public key (PEM) of a CloudFront key pair, the gallery then loads images via signed CloudFront URLs.
+# The private key has to be stored in the Secrets Manager secret "GalleryCloudFrontPrivateKey".
+# export GALLERY_CLOUDFRONT_PUBLIC_KEY="$(cat gallery_public_key.pem)"
+
+# optional: "efs" (default) loads models from the shared EFS file system, "nvme" from the GPU instance store
+# export MODEL_PLACEMENT=efs
+
+# optional: ComfyUI keeps the node outputs of this many recent prompts (more GPU memory), repeat generations
+# for the same photo then skip face analysis. "0" (default) is off.
+# export COMFYUI_CACHE_LRU=50
@@ -38,5 +38,25 @@ else
     echo "Requirements already installed. Skipping."
 fi
 
+COMFYUI_ARGS=(--listen 0.0.0.0 --port 8181 --output-directory "$EFS_MOUNT/output/")
+
+# ComfyUI reads the extra_model_paths.yaml next to main.py on EFS, which is only copied from the
+# image on the first start. The instance store paths come from the image on every start instead.
+if [ "${MODEL_PLACEMENT:-efs}" = "nvme" ]; then
+    COMFYUI_ARGS+=(--extra-model-paths-config /app/ComfyUI/extra_model_paths_nvme.yaml)
+fi
+
+# Opt-in: keep node outputs of the last COMFYUI_CACHE_LRU prompts, so repeat generations for the same
+# photo skip face analysis. This holds more GPU memory. 0 (default) keeps ComfyUI's default cache.
+# The ComfyUI checkout on EFS may predate the flag, it would refuse to start with it.
+COMFYUI_CACHE_LRU="${COMFYUI_CACHE_LRU:-0}"
+if [ "$COMFYUI_CACHE_LRU" != "0" ]; then
+    if python "$EFS_MOUNT/main.py" --help 2>/dev/null | grep -q -- "--cache-lru"; then
+        COMFYUI_ARGS+=(--cache-lru "$COMFYUI_CACHE_LRU")
+    else
+        echo "ComfyUI does not support --cache-lru. Starting without the LRU cache."
+    fi
+fi
+
 echo "Starting ComfyUI..."
-exec python "$EFS_MOUNT/main.py" --listen 0.0.0.0 --port 8181 --output-directory "$EFS_MOUNT/output/"
\ No newline at end of file
+exec python "$EFS_MOUNT/main.py" "${COMFYUI_ARGS[@]}"
\ No newline at end of file
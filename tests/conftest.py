@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+# The apps are flat scripts copied into their containers, import their modules the same way
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in (ROOT, os.path.join(ROOT, "comfyui_avatar_app"), os.path.join(ROOT, "comfyui_avatar_gallery")):
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+
+
+@pytest.fixture
+def s3():
+    moto = pytest.importorskip("moto")
+    import boto3
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1", aws_access_key_id="test",
+                              aws_secret_access_key="test")
+        client.create_bucket(Bucket="avatar-bucket")
+        yield client
+
+
+@pytest.fixture
+def fake_comfyui():
+    from fake_comfyui import FakeComfyUI
+    server = FakeComfyUI().start()
+    yield server
+    server.stop()
@@ -0,0 +1,218 @@
+"""
+A local stand-in for the ComfyUI server: /prompt, /history, /view, /upload/image and the /ws
+websocket. Queued prompts finish immediately, their events and images are pushed to the
+websocket of the prompt's client_id.
+"""
+import base64
+import hashlib
+import io
+import json
+import socket
+import struct
+import threading
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+def png_bytes(color="red"):
+    with io.BytesIO() as buf:
+        Image.new("RGB", (8, 8), color).save(buf, format="PNG")
+        return buf.getvalue()
+
+def ws_frame(payload, opcode):
+    header = bytes([0x80 | opcode])
+    if len(payload) < 126:
+        header += bytes([len(payload)])
+    elif len(payload) < 1 << 16:
+        header += bytes([126]) + struct.pack("!H", len(payload))
+    else:
+        header += bytes([127]) + struct.pack("!Q", len(payload))
+    return header + payload
+
+def read_ws_frame(rfile):
+    head = rfile.read(2)
+    if len(head) < 2:
+        return None, b""
+    opcode, length = head[0] & 0x0F, head[1] & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", rfile.read(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", rfile.read(8))[0]
+    mask = rfile.read(4) if head[1] & 0x80 else b"\0\0\0\0"
+    payload = bytes(b ^ mask[i % 4] for i, b in enumerate(rfile.read(length)))
+    return opcode, payload
+
+class FakeComfyUI(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeComfyUIHandler)
+        self.image = png_bytes()
+        self.queue_remaining = 0
+        self.node_types = {"LoadImage", "PreviewImage", "SaveImageWebsocket"}
+        # "ok", "error" (execution_error), "drop" (websocket closed once, mid-prompt) or "silent" (no events)
+        self.ws_behaviour = "ok"
+        self.prompts = []
+        self.uploads = []
+        self.history = {}
+        self.requests = []
+        self.connections = 0
+        # Status codes answered to the next POST /prompt requests instead of queueing them
+        self.prompt_errors = []
+        self._sockets = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True)
+
+    @property
+    def endpoint(self):
+        return f"127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        with self._lock:
+            for ws_socket in self._sockets.values():
+                try:
+                    ws_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self.server_close()
+
+    def send_ws(self, client_id, payload, opcode):
+        with self._lock:
+            ws_socket = self._sockets.get(client_id)
+        if ws_socket is not None:
+            with self._send_lock:
+                ws_socket.sendall(ws_frame(payload, opcode))
+
+    def send_event(self, client_id, event_type, data):
+        self.send_ws(client_id, json.dumps({"type": event_type, "data": data}).encode(), 0x1)
+
+    def drop_ws(self, client_id):
+        with self._lock:
+            ws_socket = self._sockets.pop(client_id, None)
+        if ws_socket is not None:
+            ws_socket.shutdown(socket.SHUT_RDWR)
+
+    def run_prompt(self, prompt_id, prompt, client_id):
+        if self.ws_behaviour == "silent":
+            return
+        if self.ws_behaviour == "drop":
+            # Only the first prompt loses its websocket
+            self.ws_behaviour = "ok"
+            self.drop_ws(client_id)
+            return
+        outputs = {}
+        for node_id, node in prompt.items():
+            if node["class_type"] not in ("PreviewImage", "SaveImageWebsocket"):
+                continue
+            self.send_event(client_id, "executing", {"node": node_id, "prompt_id": prompt_id})
+            if self.ws_behaviour == "error":
+                self.send_event(client_id, "execution_error",
+                                {"prompt_id": prompt_id, "exception_message": "out of memory"})
+                return
+            if node["class_type"] == "SaveImageWebsocket":
+                # Event type 1 (preview image) and format 2 (PNG), as sent by ComfyUI
+                self.send_ws(client_id, struct.pack(">II", 1, 2) + self.image, 0x2)
+            else:
+                outputs[node_id] = {"images": [{"filename": f"{prompt_id}.png", "subfolder": "",
+                                                "type": "temp"}]}
+        self.history[prompt_id] = {"outputs": outputs}
+        self.send_event(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+
+class FakeComfyUIHandler(BaseHTTPRequestHandler):
+    # Keep-alive like ComfyUI's aiohttp server
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server._lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, value, status=200):
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        self.server.requests.append(("GET", url.path))
+        if url.path == "/ws":
+            self.serve_websocket(urllib.parse.parse_qs(url.query)["clientId"][0])
+        elif url.path == "/prompt":
+            self.send_json({"exec_info": {"queue_remaining": self.server.queue_remaining}})
+        elif url.path.startswith("/object_info/"):
+            class_type = url.path[len("/object_info/"):]
+            self.send_json({class_type: {"input": {}}} if class_type in self.server.node_types else {})
+        elif url.path.startswith("/history/"):
+            prompt_id = url.path[len("/history/"):]
+            history = self.server.history.get(prompt_id)
+            self.send_json({prompt_id: history} if history else {})
+        elif url.path == "/view":
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(self.server.image)))
+            self.end_headers()
+            self.wfile.write(self.server.image)
+        else:
+            self.send_json({}, status=404)
+
+    def do_POST(self):
+        self.server.requests.append(("POST", self.path))
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/prompt" and self.server.prompt_errors:
+            self.send_json({"error": "unavailable"}, status=self.server.prompt_errors.pop(0))
+        elif self.path == "/prompt":
+            data = json.loads(body)
+            prompt_id = str(uuid.uuid4())
+            self.server.prompts.append(data["prompt"])
+            self.send_json({"prompt_id": prompt_id, "number": len(self.server.prompts)})
+            threading.Thread(target=self.server.run_prompt,
+                             args=(prompt_id, data["prompt"], data["client_id"]), daemon=True).start()
+        elif self.path == "/upload/image":
+            self.server.uploads.append(body)
+            self.send_json({"name": "input.jpeg", "subfolder": "", "type": "input"})
+        else:
+            self.send_json({}, status=404)
+
+    def serve_websocket(self, client_id):
+        accept = base64.b64encode(hashlib.sha1((self.headers["Sec-WebSocket-Key"] + WS_GUID).encode()).digest())
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept.decode())
+        self.end_headers()
+        self.wfile.flush()
+        with self.server._lock:
+            self.server._sockets[client_id] = self.connection
+        self.server.send_event(client_id, "status", {"sid": client_id})
+        try:
+            while True:
+                opcode, payload = read_ws_frame(self.rfile)
+                if opcode is None:
+                    break
+                if opcode == 0x8:
+                    with self.server._send_lock:
+                        self.connection.sendall(ws_frame(payload[:2], 0x8))
+                    break
+        except OSError:
+            pass
+        finally:
+            with self.server._lock:
+                if self.server._sockets.get(client_id) is self.connection:
+                    del self.server._sockets[client_id]
+        self.close_connection = True
@@ -0,0 +1,80 @@
+import socket
+import time
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+pytest.importorskip("websocket")
+
+from comfyui_client import ComfyUIBackendPool, ComfyUIClient, comfyui_http_session, target_group_endpoints
+from fake_comfyui import FakeComfyUI
+
+
+@pytest.fixture
+def backends():
+    servers = [FakeComfyUI().start() for _ in range(3)]
+    yield servers
+    for server in servers:
+        server.stop()
+
+
+def dead_endpoint():
+    # A port nothing listens on: connections are refused right away
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"127.0.0.1:{sock.getsockname()[1]}"
+
+
+def make_pool(endpoints, discover=None):
+    client = ComfyUIClient(endpoints[0], comfyui_http_session(4, 0), (1, 2))
+    return ComfyUIBackendPool(client, endpoints, refresh_interval=60, discover=discover)
+
+
+def test_acquire_routes_to_shortest_queue(backends):
+    backends[0].queue_remaining = 5
+    backends[1].queue_remaining = 0
+    backends[2].queue_remaining = 1
+    pool = make_pool([server.endpoint for server in backends])
+    assert pool.acquire() == backends[1].endpoint
+    # Prompts routed since the last poll count as load
+    assert pool.acquire() == backends[1].endpoint
+    assert pool.acquire() == backends[2].endpoint
+
+
+def test_dead_backend_is_skipped_without_retries(backends):
+    dead = dead_endpoint()
+    pool = make_pool([dead] + [server.endpoint for server in backends])
+    start = time.time()
+    healthy = pool.healthy_backends()
+    assert time.time() - start < 1.5
+    assert sorted(backend.endpoint for backend in healthy) == sorted(server.endpoint for server in backends)
+    assert dead not in {pool.acquire() for _ in range(6)}
+
+
+def test_discovery_replaces_backends(backends):
+    discovered = [backends[0].endpoint]
+    pool = make_pool([backends[0].endpoint], discover=lambda: list(discovered))
+    assert [backend.endpoint for backend in pool.healthy_backends()] == [backends[0].endpoint]
+    discovered[:] = [server.endpoint for server in backends[1:]]
+    pool.refresh(force=True)
+    assert sorted(backend.endpoint for backend in pool.healthy_backends()) == \
+        sorted(server.endpoint for server in backends[1:])
+    # An empty discovery result keeps the known backends
+    discovered[:] = []
+    pool.refresh(force=True)
+    assert len(pool.healthy_backends()) == 2
+
+
+def test_target_group_endpoints_returns_healthy_task_ips():
+    elbv2 = boto3.client("elbv2", region_name="us-east-1", aws_access_key_id="test", aws_secret_access_key="test")
+    arn = "arn:aws:elasticloadbalancing:us-east-1:123456789012:targetgroup/EcsComfyUIAPITargetGroupInternal/abc"
+    with Stubber(elbv2) as stubber:
+        stubber.add_response("describe_target_health", {"TargetHealthDescriptions": [
+            {"Target": {"Id": "10.0.1.12", "Port": 8181}, "TargetHealth": {"State": "healthy"}},
+            {"Target": {"Id": "10.0.2.7", "Port": 8181}, "TargetHealth": {"State": "draining"}},
+            {"Target": {"Id": "10.0.0.5", "Port": 8181}, "TargetHealth": {"State": "healthy"}},
+        ]}, {"TargetGroupArn": arn})
+        stubber.add_client_error("describe_target_health", "AccessDenied")
+        assert target_group_endpoints(elbv2, arn) == ["10.0.0.5:8181", "10.0.1.12:8181"]
+        assert target_group_endpoints(elbv2, arn) == []
@@ -0,0 +1,147 @@
+import time
+import uuid
+
+import pytest
+from urllib3.exceptions import NewConnectionError, ReadTimeoutError
+
+pytest.importorskip("websocket")
+
+from comfyui_client import (AvatarGenerationError, ComfyUIClient, ComfyUIRetry, comfyui_http_session, pool_stats,
+                            use_websocket_output, wait_for_prompt_ws)
+
+
+def workflow():
+    return {
+        "53": {"inputs": {"image": "input.jpeg"}, "class_type": "LoadImage"},
+        "57": {"inputs": {"images": ["53", 0]}, "class_type": "PreviewImage"},
+    }
+
+
+def make_client(server, **kwargs):
+    return ComfyUIClient(server.endpoint, comfyui_http_session(4, 0), (1, 5), **kwargs)
+
+
+def test_wait_for_prompt_ws_collects_websocket_images(fake_comfyui):
+    client = make_client(fake_comfyui)
+    client_id = str(uuid.uuid4())
+    ws = client.open_websocket("session", client_id, None, timeout=5)
+    try:
+        prompt_data = use_websocket_output(workflow(), ["57"])
+        prompt_id = client.queue_prompt(prompt_data, "session", client_id, None)["prompt_id"]
+        images = {"57": []}
+        assert wait_for_prompt_ws(ws, prompt_id, 5, images) is True
+    finally:
+        ws.close()
+    assert images == {"57": [fake_comfyui.image]}
+
+
+def test_wait_for_prompt_ws_reports_execution_error(fake_comfyui):
+    fake_comfyui.ws_behaviour = "error"
+    client = make_client(fake_comfyui)
+    client_id = str(uuid.uuid4())
+    ws = client.open_websocket("session", client_id, None, timeout=5)
+    try:
+        prompt_id = client.queue_prompt(workflow(), "session", client_id, None)["prompt_id"]
+        assert wait_for_prompt_ws(ws, prompt_id, 5) is False
+    finally:
+        ws.close()
+
+
+def test_wait_for_prompt_ws_times_out(fake_comfyui):
+    fake_comfyui.ws_behaviour = "silent"
+    client = make_client(fake_comfyui)
+    client_id = str(uuid.uuid4())
+    ws = client.open_websocket("session", client_id, None, timeout=5)
+    try:
+        prompt_id = client.queue_prompt(workflow(), "session", client_id, None)["prompt_id"]
+        assert wait_for_prompt_ws(ws, prompt_id, 0.5) is None
+    finally:
+        ws.close()
+
+
+def test_get_images_websocket_output_skips_history(fake_comfyui):
+    client = make_client(fake_comfyui)
+    images = client.get_images(workflow(), "session", str(uuid.uuid4()), fake_comfyui.endpoint)
+    assert images == {"57": [fake_comfyui.image]}
+    assert fake_comfyui.prompts[0]["57"]["class_type"] == "SaveImageWebsocket"
+    assert not [path for _, path in fake_comfyui.requests if path.startswith(("/history", "/view"))]
+
+
+def test_get_images_preview_output_reads_history(fake_comfyui):
+    client = make_client(fake_comfyui, output_mode="history")
+    images = client.get_images(workflow(), "session", str(uuid.uuid4()), fake_comfyui.endpoint)
+    assert images == {"57": [fake_comfyui.image]}
+    assert fake_comfyui.prompts[0]["57"]["class_type"] == "PreviewImage"
+
+
+def test_get_images_execution_error(fake_comfyui):
+    fake_comfyui.ws_behaviour = "error"
+    client = make_client(fake_comfyui)
+    with pytest.raises(AvatarGenerationError):
+        client.get_images(workflow(), "session", str(uuid.uuid4()), fake_comfyui.endpoint)
+
+
+def test_queue_prompt_is_retried_on_503_only(fake_comfyui):
+    client = ComfyUIClient(fake_comfyui.endpoint, comfyui_http_session(4, 3), (1, 5))
+    fake_comfyui.prompt_errors = [503]
+    assert client.queue_prompt(workflow(), "session", "client", None)["prompt_id"]
+    assert fake_comfyui.requests.count(("POST", "/prompt")) == 2
+
+    # After a 502 the prompt may already be queued behind the load balancer
+    fake_comfyui.requests.clear()
+    fake_comfyui.prompt_errors = [502]
+    assert client.queue_prompt(workflow(), "session", "client", None) is None
+    assert fake_comfyui.requests.count(("POST", "/prompt")) == 1
+
+
+def test_get_images_requeues_preview_graph_when_websocket_drops(fake_comfyui):
+    fake_comfyui.ws_behaviour = "drop"
+    client = make_client(fake_comfyui)
+    prompt_data = workflow()
+    images = client.get_images(prompt_data, "session", str(uuid.uuid4()), fake_comfyui.endpoint, overall_timeout=10)
+    assert images == {"57": [fake_comfyui.image]}
+    assert [prompt["57"]["class_type"] for prompt in fake_comfyui.prompts] == ["SaveImageWebsocket", "PreviewImage"]
+    assert prompt_data["57"]["class_type"] == "PreviewImage"
+
+
+def test_get_images_websocket_timeout_fails_fast(fake_comfyui):
+    fake_comfyui.ws_behaviour = "silent"
+    client = make_client(fake_comfyui)
+    start = time.time()
+    with pytest.raises(AvatarGenerationError):
+        client.get_images(workflow(), "session", str(uuid.uuid4()), fake_comfyui.endpoint, overall_timeout=1)
+    assert time.time() - start < 3
+    assert not [path for _, path in fake_comfyui.requests if path.startswith("/history")]
+
+
+def test_has_node_checks_object_info(fake_comfyui):
+    client = make_client(fake_comfyui)
+    assert client.has_node("SaveImageWebsocket") is True
+    assert client.has_node("ReActorBuildFaceModel") is False
+    fake_comfyui.node_types.add("ReActorBuildFaceModel")
+    # Answers are remembered for the lifetime of the client
+    assert client.has_node("ReActorBuildFaceModel") is False
+    assert fake_comfyui.requests.count(("GET", "/object_info/ReActorBuildFaceModel")) == 1
+
+
+def test_session_reuses_one_connection(fake_comfyui):
+    http_session = comfyui_http_session(4, 3)
+    client = ComfyUIClient(fake_comfyui.endpoint, http_session, (1, 5))
+    for _ in range(20):
+        assert client.request("prompt")["exec_info"]["queue_remaining"] == 0
+    assert fake_comfyui.connections == 1
+    assert pool_stats(http_session) == {"connections": 1, "requests": 20, "reused": 19}
+
+
+def test_retry_policy_only_retries_post_before_it_reaches_comfyui():
+    retry = ComfyUIRetry(total=3, status_forcelist=[502, 503], allowed_methods=["GET"])
+    assert retry.is_retry("POST", 503)
+    assert not retry.is_retry("POST", 502)
+    assert retry.is_retry("GET", 502)
+    # A refused connection never reached ComfyUI, a read timeout may have queued the prompt
+    connect_error = NewConnectionError(None, "Connection refused")
+    assert retry.increment("POST", "/prompt", error=connect_error).total == 2
+    with pytest.raises(ReadTimeoutError):
+        retry.increment("POST", "/prompt", error=ReadTimeoutError(None, "/prompt", "timed out"))
+    assert retry.increment("GET", "/prompt", error=ReadTimeoutError(None, "/prompt", "timed out")).total == 2
+
@@ -0,0 +1,79 @@
+"""
+Gallery timings against moto with a simulated S3 round trip. Run with -s to see the numbers:
+    python -m pytest -q -s tests/test_gallery_benchmarks.py
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("moto")
+
+from gallery_images import move_objects, prefetch
+from gallery_index import GalleryIndex, ImageCache
+
+BUCKET = "avatar-bucket"
+EVENTS = "gallery-index/events/"
+# moto answers in well under a millisecond, S3 from a Fargate task takes tens of milliseconds
+ROUND_TRIP = 0.02
+
+
+def add_latency(s3):
+    s3.meta.events.register("before-send.s3", lambda **kwargs: time.sleep(ROUND_TRIP))
+
+
+def put_avatars(s3, prefix, count, body=b"x"):
+    keys = [f"{prefix}avatar-{i:04d}.jpeg" for i in range(count)]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(lambda key: s3.put_object(Bucket=BUCKET, Key=key, Body=body), keys))
+    return keys
+
+
+def timed_move(s3, workers, keys):
+    index = GalleryIndex(s3, BUCKET, ["avatars/", "gallery/"], EVENTS, refresh_interval=0)
+    index.refresh()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        moved, _ = move_objects(s3, executor, index, ImageCache(s3, 1024, 60),
+                                [(key, f"gallery/{key.split('/')[-1]}") for key in keys])
+    assert len(moved) == len(keys)
+    return time.perf_counter() - start
+
+
+def test_benchmark_move_images(s3):
+    sequential_keys = put_avatars(s3, "avatars/one-", 100)
+    concurrent_keys = put_avatars(s3, "avatars/many-", 100)
+    add_latency(s3)
+    sequential = timed_move(s3, 1, sequential_keys)
+    concurrent = timed_move(s3, 16, concurrent_keys)
+    print(f"\nmove 100 avatars: 1 worker {sequential * 1000:.0f} ms, 16 workers {concurrent * 1000:.0f} ms")
+    assert concurrent < sequential / 3
+
+
+def timed_page(s3, workers, keys):
+    # A fresh cache per run, every image is a get_object round trip
+    cache = ImageCache(s3, 64 * 1024 * 1024, 60)
+    start = time.perf_counter()
+    first = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _, image in prefetch(executor, lambda key: cache.get(BUCKET, key), keys):
+            assert image
+            if first is None:
+                first = time.perf_counter() - start
+    return first, time.perf_counter() - start
+
+
+def test_benchmark_gallery_page(s3):
+    put_avatars(s3, "gallery/", 200, body=b"x" * 20 * 1024)
+    index = GalleryIndex(s3, BUCKET, ["gallery/"], EVENTS, refresh_interval=0)
+    # The first page of 50, newest first, as paginate() hands it to display_gallery
+    page = index.images("gallery/")[:50]
+    add_latency(s3)
+    sequential_first, sequential_full = timed_page(s3, 1, page)
+    concurrent_first, concurrent_full = timed_page(s3, 16, page)
+    print(f"\ngallery page of 50: 1 worker first image {sequential_first * 1000:.0f} ms, "
+          f"full page {sequential_full * 1000:.0f} ms; 16 workers first image {concurrent_first * 1000:.0f} ms, "
+          f"full page {concurrent_full * 1000:.0f} ms")
+    assert concurrent_full < sequential_full / 3
+    # The first tile does not wait for the rest of the page
+    assert concurrent_first < concurrent_full / 2
@@ -0,0 +1,127 @@
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from PIL import Image
+
+pytest.importorskip("moto")
+
+from gallery_images import encode_thumbnails, move_objects, prefetch, thumbnail_key
+from gallery_index import GalleryIndex, ImageCache
+
+BUCKET = "avatar-bucket"
+EVENTS = "gallery-index/events/"
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        yield executor
+
+
+def png_bytes(size):
+    with io.BytesIO() as buf:
+        Image.effect_mandelbrot((size, size), (-2, -1.5, 1, 1.5), 100).convert("RGB").save(buf, format="PNG")
+        return buf.getvalue()
+
+
+def record_calls(s3, operation):
+    calls = []
+    s3.meta.events.register(f"before-parameter-build.s3.{operation}",
+                            lambda params, **kwargs: calls.append((threading.current_thread().name, params)))
+    return calls
+
+
+def test_move_of_more_than_1000_keys(s3, executor):
+    sources = [f"avatars/avatar-{i:04d}.jpeg" for i in range(1500)]
+    list(executor.map(lambda key: s3.put_object(Bucket=BUCKET, Key=key, Body=b"x"), sources))
+    index = GalleryIndex(s3, BUCKET, ["avatars/", "gallery/"], EVENTS, refresh_interval=0)
+    assert len(index.images("avatars/")) == 1500
+    copies = record_calls(s3, "CopyObject")
+    deletes = record_calls(s3, "DeleteObjects")
+
+    moves = [(key, f"gallery/{key.split('/')[-1]}") for key in sources]
+    moved, failed = move_objects(s3, executor, index, ImageCache(s3, 1024, 60), moves)
+
+    assert sorted(moved) == moves and failed == []
+    # Copies run on the executor's workers, not one after another on the calling thread
+    assert len({thread for thread, _ in copies}) > 1
+    assert [len(params["Delete"]["Objects"]) for _, params in deletes] == [1000, 500]
+    assert s3.list_objects_v2(Bucket=BUCKET, Prefix="avatars/")["KeyCount"] == 0
+    assert len(index.images("gallery/")) == 1500 and index.images("avatars/") == []
+
+    # One batch event for the whole move, readers apply it with a single get
+    event_keys = [item["Key"] for item in s3.list_objects_v2(Bucket=BUCKET, Prefix=EVENTS)["Contents"]]
+    assert len(event_keys) == 1
+    event = json.loads(s3.get_object(Bucket=BUCKET, Key=event_keys[0])["Body"].read())
+    assert event["op"] == "batch" and len(event["events"]) == 3000
+    reader = GalleryIndex(s3, BUCKET, ["avatars/", "gallery/"], EVENTS, refresh_interval=0)
+    assert len(reader.images("gallery/")) == 1500
+
+
+def test_failed_copy_keeps_the_source(s3, executor):
+    s3.put_object(Bucket=BUCKET, Key="avatars/a.jpeg", Body=b"a")
+    index = GalleryIndex(s3, BUCKET, ["avatars/", "gallery/"], EVENTS, refresh_interval=0)
+    index.refresh()
+    moved, failed = move_objects(s3, executor, index, ImageCache(s3, 1024, 60),
+                                 [("avatars/a.jpeg", "gallery/a.jpeg"), ("avatars/gone.jpeg", "gallery/gone.jpeg")])
+    assert moved == [("avatars/a.jpeg", "gallery/a.jpeg")]
+    assert [pair for pair, _ in failed] == [("avatars/gone.jpeg", "gallery/gone.jpeg")]
+    assert index.images("gallery/") == ["gallery/a.jpeg"]
+
+
+class MediaFiles:
+    """Stands in for Streamlit's media file manager, keeps what st.image would serve."""
+
+    def __init__(self):
+        self.files = []
+
+    def add(self, data, mimetype, file_id):
+        self.files.append((data, mimetype))
+        return f"/media/{len(self.files)}"
+
+
+def served_by_st_image(monkeypatch, data):
+    image_module = pytest.importorskip("streamlit.elements.image")
+    media_files = MediaFiles()
+    instance = type("Runtime", (), {"media_file_mgr": media_files})()
+    monkeypatch.setattr(image_module.runtime, "exists", lambda: True)
+    monkeypatch.setattr(image_module.runtime, "get_instance", lambda: instance)
+    monkeypatch.setattr(image_module.caching, "save_media_data", lambda *args: None)
+    # What st.image(data, use_column_width=True) does with the bytes
+    image_module.image_to_url(data, image_module.WidthBehaviour.COLUMN, False, "RGB", "auto", "tile")
+    return media_files.files[0]
+
+
+def test_jpeg_thumbnails_are_served_unchanged(monkeypatch):
+    avatar = png_bytes(1024)
+    for size, rendition in encode_thumbnails(avatar, (128, 256, 512), "JPEG").items():
+        assert Image.open(io.BytesIO(rendition)).size == (size, size)
+        assert served_by_st_image(monkeypatch, rendition) == (rendition, "image/jpeg")
+
+
+def test_webp_thumbnails_would_be_reencoded(monkeypatch):
+    # Why the proxy path does not use WebP: st.image decodes it and sends a new JPEG
+    rendition = encode_thumbnails(png_bytes(256), (128,), "WEBP")[128]
+    data, mimetype = served_by_st_image(monkeypatch, rendition)
+    assert mimetype == "image/jpeg" and data != rendition
+
+
+def test_thumbnail_key_extension_follows_format():
+    assert thumbnail_key("thumbnails/", "gallery/avatar-1.jpeg", 128, "JPEG") == \
+        "thumbnails/128/avatar-1.jpeg.jpeg"
+    assert thumbnail_key("thumbnails/", "avatars/avatar-1.jpeg", 256, "WEBP") == \
+        "thumbnails/256/avatar-1.jpeg.webp"
+
+
+def test_prefetch_survives_a_failed_tile(s3, executor):
+    keys = [f"gallery/avatar-{i}.jpeg" for i in range(5)]
+    for key in keys[:2] + keys[3:]:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=key.encode())
+    cache = ImageCache(s3, 1024, 60)
+    # keys[2] was moderated away after the listing, get_object answers NoSuchKey
+    results = dict(prefetch(executor, lambda key: cache.get(BUCKET, key), keys))
+    assert results == {0: keys[0].encode(), 1: keys[1].encode(), 2: None, 3: keys[3].encode(),
+                       4: keys[4].encode()}
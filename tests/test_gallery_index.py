@@ -0,0 +1,117 @@
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("moto")
+
+from gallery_index import GalleryIndex, ImageCache
+
+BUCKET = "avatar-bucket"
+EVENTS = "gallery-index/events/"
+
+
+def write_event(s3, events, age=0):
+    # age back-dates the key like a writer with a slow PUT or a clock running behind
+    key = f"{EVENTS}{time.time_ns() - int(age * 10**9):020d}-{uuid.uuid4().hex[:8]}.json"
+    s3.put_object(Bucket=BUCKET, Key=key, Body=json.dumps({"op": "batch", "events": events}).encode())
+    return key
+
+
+def put_event(key):
+    return {"op": "put", "key": key, "last_modified": time.time(), "etag": '"etag"'}
+
+
+def count_listings(s3):
+    listings = []
+    s3.meta.events.register("before-parameter-build.s3.ListObjectsV2",
+                            lambda params, **kwargs: listings.append(params.get("Prefix")))
+    return listings
+
+
+def test_ten_thousand_objects_are_listed_once(s3):
+    keys = [f"avatars/avatar-{i:05d}.jpeg" for i in range(10000)]
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(lambda key: s3.put_object(Bucket=BUCKET, Key=key, Body=b"x"), keys))
+    s3.put_object(Bucket=BUCKET, Key="avatars/notes.txt", Body=b"x")
+
+    listings = count_listings(s3)
+    index = GalleryIndex(s3, BUCKET, ["avatars/", "gallery/"], EVENTS, refresh_interval=0)
+    assert len(index.images("avatars/")) == 10000
+    assert index.images("gallery/") == []
+    full_listings = len(listings)
+
+    write_event(s3, [{"op": "delete", "key": keys[0]}, put_event("gallery/avatar-00000.jpeg")])
+    images = index.images("avatars/")
+    assert len(images) == 9999 and keys[0] not in images
+    assert index.images("gallery/") == ["gallery/avatar-00000.jpeg"]
+    # Bumped once by the bootstrap and once by the event
+    assert index.version_of("gallery/") == 2
+    # Every refresh after the bootstrap only lists the event prefix
+    assert set(listings[full_listings:]) == {EVENTS}
+
+
+def test_late_event_is_not_skipped(s3):
+    index = GalleryIndex(s3, BUCKET, ["avatars/"], EVENTS, refresh_interval=0, lag=30)
+    assert index.images("avatars/") == []
+
+    write_event(s3, [put_event("avatars/new.jpeg")])
+    assert index.images("avatars/") == ["avatars/new.jpeg"]
+
+    # Becomes visible after the newer event was applied, but is still inside the lag window
+    write_event(s3, [put_event("avatars/late.jpeg")], age=10)
+    assert sorted(index.images("avatars/")) == ["avatars/late.jpeg", "avatars/new.jpeg"]
+
+
+def test_events_are_applied_once(s3):
+    index = GalleryIndex(s3, BUCKET, ["avatars/"], EVENTS, refresh_interval=0)
+    index.refresh()
+    gets = []
+    s3.meta.events.register("before-parameter-build.s3.GetObject", lambda params, **kwargs: gets.append(params))
+
+    write_event(s3, [put_event("avatars/a.jpeg")])
+    index.refresh()
+    version = index.version
+    index.refresh()
+    assert len(gets) == 1 and index.version == version
+
+    # Events written by this process are applied directly and skipped in the listing
+    events = [put_event("avatars/b.jpeg")]
+    index.apply(write_event(s3, events), events)
+    index.refresh()
+    assert len(gets) == 1
+    assert sorted(index.images("avatars/")) == ["avatars/a.jpeg", "avatars/b.jpeg"]
+
+
+def test_applied_keys_are_pruned_behind_the_cursor(s3):
+    index = GalleryIndex(s3, BUCKET, ["avatars/"], EVENTS, refresh_interval=0, lag=0.2)
+    index.refresh()
+    write_event(s3, [put_event("avatars/a.jpeg")])
+    index.refresh()
+    time.sleep(0.3)
+    index.refresh()
+    assert index._applied == set()
+    assert index.images("avatars/") == ["avatars/a.jpeg"]
+
+
+def test_image_cache_revalidates_with_etag(s3):
+    s3.put_object(Bucket=BUCKET, Key="avatars/a.jpeg", Body=b"first")
+    cache = ImageCache(s3, max_bytes=1024, revalidate_after=0)
+    assert cache.get(BUCKET, "avatars/a.jpeg") == b"first"
+    assert cache.get(BUCKET, "avatars/a.jpeg") == b"first"
+    assert cache.stats()["revalidations"] == 1
+    s3.put_object(Bucket=BUCKET, Key="avatars/a.jpeg", Body=b"second")
+    assert cache.get(BUCKET, "avatars/a.jpeg") == b"second"
+    assert cache.stats()["bytes"] == len(b"second")
+
+
+def test_image_cache_rename_replaces_existing_entry(s3):
+    cache = ImageCache(s3, max_bytes=1024, revalidate_after=60)
+    cache.add("avatars/a.jpeg", '"a"', b"new avatar")
+    cache.add("gallery/a.jpeg", '"old"', b"older gallery copy")
+    cache.rename("avatars/a.jpeg", "gallery/a.jpeg", '"a"')
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["bytes"] == len(b"new avatar")
+    assert cache.get(BUCKET, "gallery/a.jpeg") == b"new avatar"
@@ -0,0 +1,100 @@
+import base64
+import json
+import time
+import urllib.parse
+
+import boto3
+import pytest
+from botocore.config import Config
+
+pytest.importorskip("cryptography")
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from image_urls import SignedUrlCache, cloudfront_url_signer, s3_url_signer, url_signer
+
+DOMAIN = "avatar-gallery.example.com"
+KEY_ID = "K2JCJMDEHXQW5F"
+
+
+@pytest.fixture(scope="module")
+def private_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture(scope="module")
+def private_key_pem(private_key):
+    return private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                     serialization.NoEncryption()).decode()
+
+
+@pytest.fixture
+def s3_client():
+    return boto3.client("s3", region_name="us-east-1", aws_access_key_id="test", aws_secret_access_key="test",
+                        config=Config(signature_version="s3v4"))
+
+
+def query(url):
+    return dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query))
+
+
+def test_cloudfront_url_has_a_verifiable_canned_policy(private_key, private_key_pem):
+    sign = cloudfront_url_signer(DOMAIN, KEY_ID, private_key_pem)
+    url = sign("gallery/avatar 1.jpeg", 1767225600)
+    resource, _ = url.split("?", 1)
+    assert resource == f"https://{DOMAIN}/gallery/avatar%201.jpeg"
+    params = query(url)
+    assert params["Key-Pair-Id"] == KEY_ID
+    assert params["Expires"] == "1767225600"
+
+    # CloudFront rebuilds the canned policy from the URL and checks it against the signature
+    policy = json.dumps({"Statement": [{"Resource": resource,
+                                        "Condition": {"DateLessThan": {"AWS:EpochTime": 1767225600}}}]},
+                        separators=(",", ":")).encode()
+    signature = base64.b64decode(params["Signature"].replace("-", "+").replace("_", "=").replace("~", "/"))
+    private_key.public_key().verify(signature, policy, padding.PKCS1v15(), hashes.SHA1())
+
+
+def test_s3_signer_is_used_without_a_key_pair(s3_client):
+    url = url_signer(s3_client, "avatar-bucket")("gallery/avatar-1.jpeg", time.time() + 600.5)
+    assert urllib.parse.urlsplit(url).netloc == "avatar-bucket.s3.amazonaws.com"
+    assert urllib.parse.urlsplit(url).path == "/gallery/avatar-1.jpeg"
+    params = query(url)
+    assert params["X-Amz-Expires"] == "600"
+    assert "Key-Pair-Id" not in params
+
+
+def test_cloudfront_signer_is_used_with_a_key_pair(s3_client, private_key_pem):
+    url = url_signer(s3_client, "avatar-bucket", DOMAIN, KEY_ID, private_key_pem)("gallery/a.jpeg", 1767225600)
+    assert url.startswith(f"https://{DOMAIN}/gallery/a.jpeg?")
+    assert query(url)["Key-Pair-Id"] == KEY_ID
+
+
+def test_s3_signer_never_asks_for_an_expired_url(s3_client):
+    url = s3_url_signer(s3_client, "avatar-bucket")("gallery/a.jpeg", time.time() - 5)
+    assert query(url)["X-Amz-Expires"] == "1"
+
+
+def test_signed_url_cache_reuses_urls_for_half_their_lifetime():
+    now = [1000.0]
+    signed = []
+
+    def sign(key, expires_at):
+        signed.append((key, expires_at))
+        return f"https://{DOMAIN}/{key}?Expires={int(expires_at)}&n={len(signed)}"
+
+    cache = SignedUrlCache(sign, ttl=3600, clock=lambda: now[0])
+    first = cache.url("gallery/a.jpeg")
+    assert signed == [("gallery/a.jpeg", 4600.0)]
+    now[0] += 1799
+    assert cache.url("gallery/a.jpeg") == first
+    # Past the refresh margin a new URL is signed, the browser never gets one about to expire
+    now[0] += 1
+    second = cache.url("gallery/a.jpeg")
+    assert second != first and signed[-1] == ("gallery/a.jpeg", 6400.0)
+    assert cache.url("gallery/a.jpeg") == second
+    # A moved avatar is signed again under its new key
+    cache.forget("gallery/a.jpeg")
+    assert cache.url("gallery/a.jpeg") != second
+    assert len(signed) == 3
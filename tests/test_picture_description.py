@@ -0,0 +1,72 @@
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import pytest
+from botocore.response import StreamingBody
+from botocore.stub import ANY, Stubber
+
+from picture_description import DESCRIBE_MODEL_ID, cancel_describe, start_describe
+
+DESCRIPTION = {"content": [{"type": "text", "text": "A person smiling at the camera."}]}
+
+
+class FakeNormalizedImage:
+
+    def __init__(self):
+        self.encodings = 0
+
+    def encoded(self, format='JPEG'):
+        self.encodings += 1
+        return b"\xff\xd8jpeg"
+
+
+@pytest.fixture
+def bedrock():
+    client = boto3.client("bedrock-runtime", region_name="us-east-1", aws_access_key_id="test",
+                          aws_secret_access_key="test")
+    with Stubber(client) as stubber:
+        yield client, stubber
+
+
+def invoke_model_response():
+    body = json.dumps(DESCRIPTION).encode()
+    return {"body": StreamingBody(io.BytesIO(body), len(body)), "contentType": "application/json"}
+
+
+def test_speculative_description_is_ready_when_asked_for(bedrock):
+    client, stubber = bedrock
+    stubber.add_response("invoke_model", invoke_model_response(), {"modelId": DESCRIBE_MODEL_ID, "body": ANY})
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = start_describe(executor, client, FakeNormalizedImage())
+        assert future.result(timeout=5) == DESCRIPTION
+    stubber.assert_no_pending_responses()
+    # Nothing left to cancel once the call has run
+    assert cancel_describe(future) is False
+
+
+def test_cancelled_description_never_calls_bedrock(bedrock):
+    client, stubber = bedrock
+    image = FakeNormalizedImage()
+    release = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # The only worker is busy, so the description is still queued when the user moves on
+        executor.submit(release.wait, 5)
+        future = start_describe(executor, client, image)
+        assert cancel_describe(future) is True
+        release.set()
+    assert future.cancelled()
+    # The stubber has no responses queued, any invoke_model call would have raised
+    assert image.encodings == 0
+    assert cancel_describe(None) is False
+
+
+def test_description_error_is_raised_from_the_future(bedrock):
+    client, stubber = bedrock
+    stubber.add_client_error("invoke_model", "ThrottlingException", http_status_code=429)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = start_describe(executor, client, FakeNormalizedImage())
+        with pytest.raises(client.exceptions.ThrottlingException):
+            future.result(timeout=5)
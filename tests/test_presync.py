@@ -0,0 +1,170 @@
+import hashlib
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("tqdm")
+
+import presync
+
+DATA = os.urandom(1024 * 1024 + 123)
+PART_SIZE = 256 * 1024
+
+
+class ModelServer(ThreadingHTTPServer):
+    """Serves DATA with byte range support. Responses to the ranges starting at an offset in
+    truncate stop after that many bytes, without Content-Length, like a dropped connection."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), ModelHandler)
+        self.ranges = True
+        self.truncate = {}
+        self.gets = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/model.safetensors"
+
+
+class ModelHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(DATA)))
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        partial = bool(match) and self.server.ranges
+        start = int(match[1]) if partial else 0
+        end = int(match[2]) if partial and match[2] else len(DATA) - 1
+        self.server.gets.append(start)
+        if partial and start >= len(DATA):
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(DATA)}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = DATA[start:end + 1]
+        self.send_response(206 if partial else 200)
+        if partial:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(DATA)}")
+        cut = self.server.truncate.pop(start, None)
+        if cut is None:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:cut] if cut is not None else body)
+
+
+@pytest.fixture
+def server():
+    server = ModelServer()
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def small_parts(monkeypatch):
+    monkeypatch.setattr(presync, "PARALLEL_DOWNLOAD_MIN_SIZE", 512 * 1024)
+    monkeypatch.setattr(presync, "PARALLEL_DOWNLOAD_PART_SIZE", PART_SIZE)
+    monkeypatch.setattr(presync, "DOWNLOAD_CHUNK_SIZE", 64 * 1024)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_short_range_is_fetched_again(server, tmp_path):
+    output_path = str(tmp_path / "checkpoints" / "model.safetensors")
+    server.truncate = {PART_SIZE: 1000}
+    with pytest.raises(IOError):
+        presync.download_file(server.url, output_path)
+    assert not os.path.exists(output_path)
+
+    server.gets.clear()
+    presync.download_file(server.url, output_path, sha256=hashlib.sha256(DATA).hexdigest())
+    assert server.gets == [PART_SIZE]
+    assert read(output_path) == DATA
+    assert not os.path.exists(f"{output_path}.part.ranges")
+
+
+def test_sequential_download_resumes(server, tmp_path):
+    server.ranges = False
+    output_path = str(tmp_path / "model.safetensors")
+    server.truncate = {0: 300 * 1024}
+    with pytest.raises(IOError):
+        presync.download_file(server.url, output_path)
+    assert os.path.getsize(f"{output_path}.part") == 300 * 1024
+
+    server.ranges = True
+    presync.download_file(server.url, output_path, size=len(DATA))
+    assert server.gets[-1] == 300 * 1024
+    assert read(output_path) == DATA
+
+
+def test_truncated_file_without_manifest_size_is_completed(server, tmp_path):
+    # Left behind by a version of the script that did not check sizes
+    output_path = str(tmp_path / "model.safetensors")
+    with open(output_path, "wb") as f:
+        f.write(DATA[:100 * 1024])
+    presync.download_file(server.url, output_path)
+    assert server.gets == [100 * 1024]
+    assert read(output_path) == DATA
+
+    server.gets.clear()
+    presync.download_file(server.url, output_path)
+    assert server.gets == []
+
+
+def test_checksum_mismatch_discards_download(server, tmp_path):
+    output_path = str(tmp_path / "model.safetensors")
+    with pytest.raises(IOError, match="Checksum mismatch"):
+        presync.download_file(server.url, output_path, sha256="0" * 64)
+    assert not os.path.exists(output_path)
+    assert not os.path.exists(f"{output_path}.part")
+
+
+def test_complete_part_file_is_finalised(server, tmp_path):
+    # An earlier sequential run wrote every byte but died before the rename
+    output_path = str(tmp_path / "model.safetensors")
+    with open(f"{output_path}.part", "wb") as f:
+        f.write(DATA)
+    presync.download_file(server.url, output_path, size=len(DATA), sha256=hashlib.sha256(DATA).hexdigest())
+    assert server.gets == [len(DATA)]
+    assert read(output_path) == DATA
+    assert not os.path.exists(f"{output_path}.part")
+
+
+def test_oversized_part_file_is_restarted(server, tmp_path):
+    output_path = str(tmp_path / "model.safetensors")
+    with open(f"{output_path}.part", "wb") as f:
+        f.write(DATA + b"garbage")
+    presync.download_file(server.url, output_path)
+    assert server.gets == [len(DATA) + len(b"garbage"), 0]
+    assert read(output_path) == DATA
+
+
+def test_existing_file_of_the_right_size_is_checked_against_sha256(server, tmp_path):
+    output_path = str(tmp_path / "model.safetensors")
+    sha256 = hashlib.sha256(DATA).hexdigest()
+    with open(output_path, "wb") as f:
+        f.write(bytes(len(DATA)))
+    presync.download_file(server.url, output_path, size=len(DATA), sha256=sha256)
+    assert read(output_path) == DATA
+
+    server.gets.clear()
+    presync.download_file(server.url, output_path, size=len(DATA), sha256=sha256)
+    assert server.gets == []
@@ -0,0 +1,115 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("moto")
+
+from comfyui_client import ResultCache
+
+BUCKET = "avatar-bucket"
+PREFIX = "result-cache/"
+
+
+class Compute:
+    """Counts the generations, optionally blocks them until released."""
+
+    def __init__(self, block=False):
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def __call__(self, value=(b"png", [])):
+        self.calls += 1
+        self.started.set()
+        assert self.release.wait(5)
+        return value
+
+
+def wait_for_joiners(caplog, count):
+    deadline = time.time() + 5
+    while sum("Joining in-flight request" in record.message for record in caplog.records) < count:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_memory_tier_is_lru():
+    cache = ResultCache(2)
+    compute = Compute()
+    assert cache.get_or_compute("a", lambda: compute((b"a", []))) == (b"a", [])
+    cache.get_or_compute("b", lambda: compute((b"b", [])))
+    # Touching "a" makes "b" the least recently used entry
+    assert cache.get_or_compute("a", compute) == (b"a", [])
+    cache.get_or_compute("c", lambda: compute((b"c", [])))
+    assert compute.calls == 3
+    assert cache.get_or_compute("a", compute) == (b"a", [])
+    assert compute.calls == 3
+    assert cache.get_or_compute("b", lambda: compute((b"b2", []))) == (b"b2", [])
+    assert compute.calls == 4
+
+
+def test_s3_tier_is_shared_across_processes(s3):
+    labels = [{"Name": "Suggestive", "Confidence": 91.0}]
+    first = ResultCache(4, s3_client=s3, s3_bucket=BUCKET, s3_prefix=PREFIX)
+    assert first.get_or_compute("abc", lambda: (b"avatar", labels)) == (b"avatar", labels)
+    stored = s3.get_object(Bucket=BUCKET, Key=f"{PREFIX}abc.png")
+    assert stored["Body"].read() == b"avatar"
+    assert stored["ContentType"] == "image/png"
+    assert json.loads(stored["Metadata"]["moderation-labels"]) == labels
+
+    # A second task with an empty memory tier is served from S3
+    second = ResultCache(4, s3_client=s3, s3_bucket=BUCKET, s3_prefix=PREFIX)
+    compute = Compute()
+    assert second.get_or_compute("abc", compute) == (b"avatar", labels)
+    assert compute.calls == 0
+
+
+def test_s3_tier_is_off_without_prefix(s3):
+    cache = ResultCache(4, s3_client=s3, s3_bucket=BUCKET)
+    cache.get_or_compute("abc", lambda: (b"avatar", []))
+    assert s3.list_objects_v2(Bucket=BUCKET).get("KeyCount") == 0
+
+
+def test_identical_requests_share_one_generation(caplog):
+    caplog.set_level(logging.INFO, logger="comfyui_client")
+    cache = ResultCache(4)
+    compute = Compute(block=True)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        owner = executor.submit(cache.get_or_compute, "abc", compute)
+        assert compute.started.wait(5)
+        joiners = [executor.submit(cache.get_or_compute, "abc", compute) for _ in range(3)]
+        # The joiners wait on the owner's Future, they never call compute
+        wait_for_joiners(caplog, 3)
+        compute.release.set()
+        results = [future.result(timeout=5) for future in [owner] + joiners]
+    assert compute.calls == 1
+    assert results == [(b"png", [])] * 4
+    assert cache._in_flight == {}
+
+
+def test_failed_generation_is_raised_to_joiners_and_not_cached(caplog):
+    caplog.set_level(logging.INFO, logger="comfyui_client")
+    cache = ResultCache(4)
+    started = threading.Event()
+    release = threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("out of memory")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        owner = executor.submit(cache.get_or_compute, "abc", fail)
+        assert started.wait(5)
+        joiner = executor.submit(cache.get_or_compute, "abc", lambda: pytest.fail("joined request computed"))
+        wait_for_joiners(caplog, 1)
+        release.set()
+        for future in (owner, joiner):
+            with pytest.raises(RuntimeError):
+                future.result(timeout=5)
+    assert cache.get_or_compute("abc", lambda: (b"png", [])) == (b"png", [])